@@ -28,6 +28,15 @@
 #
 ###############################################################################
 
+from threading import local
+
+# Results of the nodes updated in the current update round of each thread, the
+# attribute "results" is None outside of a round
+_update_round = local()
+
+def _current_round():
+    return getattr(_update_round,"results",None)
+
 class BasicCalculator(object):
     """
         BasicCalculator:
@@ -105,14 +114,40 @@ class BasicCalculator(object):
         eggs.internal_spam = 4 # Works, but should only be used in the update method
 
         print eggs.spam # prints "4"
+
+        Input variables whose values are themselves BasicCalculator objects are the
+        child nodes of a calculator. They span a directed acyclic graph, which can be
+        inspected via the dependencies(), calculator_graph() and update_order() methods.
+        Calling update() on a node starts an "update round": all nodes of its graph are
+        updated exactly once, children before their parents. Within a round, further 
+        update() calls (e.g. the ones in the do_update methods of the parents) just 
+        return the result of the node's update. Hence, subtrees that are shared
+        between several parents are evaluated only once and every parent sees their
+        change. A node whose inputs were changed during the round (e.g. by the
+        do_update method of a parent) is updated again by its next update() call.
+        The round is local to the thread that started it, so independent trees can
+        be updated concurrently.
     """
+
+    # Storage layout: the values of all variables are kept directly in the instance
+    # dictionary, so reading them is a plain attribute lookup that never reaches 
+    # __getattr__. The _input_variables/_output_variables dictionaries hold the same
+    # values and serve as registry. Changes of the input variables are tracked in the
+    # bitmask _dirty, using the bit assigned to each input variable in _input_bits.
+
     def __init__(self):
+        self.__init_storage()
+
+    def __init_storage(self):
         self.__dict__["_input_variables"]  = {}
-        self.__dict__["_output_variables"]  = {}
-        self.__dict__["_changes"]  = {}
+        self.__dict__["_output_variables"] = {}
+        self.__dict__["_input_bits"]       = {}
+        self.__dict__["_dirty"]            = 0
 
     @staticmethod
     def check_reserved(name):
+        if name.startswith("_"):
+            raise KeyError("Variable names starting with '_' are reserved.")
         if name.startswith("internal_"):
             raise KeyError("Variable names starting with 'internal_' are reserved.")
         if name.startswith("changed_"):
@@ -124,22 +159,26 @@ class BasicCalculator(object):
 
     def set_input_variable(self,name,value):
         BasicCalculator.check_reserved(name)
-        self.__dict__["_input_variables"][name] = value
-        self.__dict__["_changes"][name] = False
+        d = self.__dict__
+        bits = d["_input_bits"]
+        if name not in bits:
+            bits[name] = 1 << len(bits)
+        d["_input_variables"][name] = value
+        d[name] = value
+        d["_dirty"] &= ~bits[name]
        
 
     def set_output_variable(self,name,value):
         BasicCalculator.check_reserved(name)
         self.__dict__["_output_variables"][name] = value
+        self.__dict__[name] = value
 
     def init_variables(self,inputs=None,outputs = None):
         if inputs == None:
             inputs = {}
         if outputs == None:
             outputs = {}
-        self.__dict__["_input_variables"]  = {}
-        self.__dict__["_output_variables"]  = {}
-        self.__dict__["_changes"]  = {}
+        self.__init_storage()
         for key,value in inputs.iteritems():
             self.set_input_variable(key,value)
         for key,value in outputs.iteritems():
@@ -147,14 +186,13 @@ class BasicCalculator(object):
 
     def init_input_variables(self,**kwargs):
         if not "_input_variables" in self.__dict__:
-            self.__dict__["_input_variables"] = {}
-            self.__dict__["_changes"] = {}
+            self.__init_storage()
         for key,value in kwargs.iteritems():
             self.set_input_variable(key,value)
 
     def init_output_variables(self,**kwargs):
         if not "_output_variables" in self.__dict__:
-            self.__dict__["_output_variables"] = {}
+            self.__init_storage()
         for key,value in kwargs.iteritems():
             self.set_output_variable(key,value)
 
@@ -162,41 +200,50 @@ class BasicCalculator(object):
         for key,value in kwargs.iteritems():
             self.__setattr__(key,value)
             
+    @property
+    def changed(self):
+        return self._dirty != 0
+
+    def changed_variables(self):
+        """
+            Returns the set of names of the input variables that have changed.
+        """
+        dirty = self._dirty
+        return set( name for name,bit in self._input_bits.iteritems() if dirty & bit )
 
     def __getattr__(self,var):
-        if var.startswith("__"):
+        # Only reached if var is not a variable (those live in the instance dictionary)
+        if var.startswith("_"):
             raise AttributeError("Attribute %s not found."%var)
         if var.startswith("changed_"):
             varname = var[8:]
-            if varname in self._changes.keys():
-                return self._changes[varname]
+            bit = self._input_bits.get(varname)
+            if bit != None:
+                return (self._dirty & bit) != 0
             else:
-                raise AttributeError("%s is not an output parameter."%varname)
-        if var == "changed":
-            return True in self._changes.values()
-
-        if var in self._input_variables.keys():
-            return self._input_variables[var]
-        if var in self._output_variables.keys():
-            return self._output_variables[var]
+                raise AttributeError("%s is not an input parameter."%varname)
         raise AttributeError("Parameter %s not found."%var)
 
     def __setattr__(self,var,val):
+        d = self.__dict__
+        bit = d["_input_bits"].get(var)
+        if bit != None:
+            d["_input_variables"][var] = val
+            d[var] = val
+            d["_dirty"] |= bit
+            return
         if var.startswith("__"):
             raise AttributeError("Attribute %s not found."%var)
         if var.startswith("internal_"):
             varname = var[9:]
-            if varname in self._output_variables.keys():
-                self._output_variables[varname]=val
+            if varname in d["_output_variables"]:
+                d["_output_variables"][varname] = val
+                d[varname] = val
             else:
                 raise AttributeError("%s is not an output parameter."%varname)
             return
 
-        if var in self._input_variables.keys():
-            self._input_variables[var] = val
-            self._changes[var] = True
-            return
-        if var in self._output_variables.keys():
+        if var in d["_output_variables"]:
             raise AttributeError("Direct setting of output variables not permitted. Use the internal_* alias for this purpose.")
         raise AttributeError("Parameter %s not found."%var)
 
@@ -206,8 +253,202 @@ class BasicCalculator(object):
     def __dir__(self):
         return self._input_variables.keys() + self._output_variables.keys()
 
+    def dependencies(self):
+        """
+            Returns the child nodes, i.e. the input variables that are BasicCalculators.
+        """
+        return [ value for value in self._input_variables.itervalues() if isinstance(value,BasicCalculator) ]
+
+    def calculator_graph(self):
+        """
+            Returns the graph below (and including) this node as a dictionary, which maps 
+            each node to the list of its child nodes.
+        """
+        graph = {}
+        stack = [ self ]
+        while stack:
+            node = stack.pop()
+            if node not in graph:
+                graph[node] = node.dependencies()
+                stack.extend(graph[node])
+        return graph
+
+    def update_order(self):
+        """
+            Returns the nodes of the graph below (and including) this node in topological
+            order, i.e. every node comes after all of its children. This node is the last one.
+        """
+        graph = self.calculator_graph()
+        order = []
+        done     = set()
+        visiting = set()
+        # Iterative depth-first search, a node is appended after all its children
+        stack = [ (self,False) ]
+        while stack:
+            node,children_done = stack.pop()
+            if children_done:
+                visiting.discard(node)
+                if node not in done:
+                    done.add(node)
+                    order.append(node)
+                continue
+            if node in done:
+                continue
+            if node in visiting:
+                raise ValueError("The calculator graph contains a cycle.")
+            visiting.add(node)
+            stack.append((node,True))
+            for child in reversed(graph[node]):
+                if child not in done:
+                    stack.append((child,False))
+        return order
+
     def update(self):
+        results = _current_round()
+        if results != None:
+            if self not in results:
+                results[self] = self.__update_node()
+            elif self._dirty:
+                # The inputs were changed within the round, the node has to be updated again
+                changed = self.__update_node()
+                results[self] = results[self] or changed
+                return changed
+            return results[self]
+        return self._run_update_round()[self]
+
+    def _run_update_round(self):
+        """
+            Updates the graph below this node in one update round and returns the 
+            results of all its nodes as a dictionary.
+        """
+        _update_round.results = results = {}
+        try:
+            for node in self.update_order():
+                node.update()
+        finally:
+            _update_round.results = None
+        return results
+
+    def parallel_update(self,executor="thread",workers=None):
+        """
+            Same as update(), but independent sibling subtrees are updated concurrently.
+
+            Starting from this node, the graph is descended as long as the nodes have a
+            single child. The children of the first node with several children span the 
+            subtrees. Subtrees in which no input has changed are updated in the calling 
+            thread, just like nodes that are shared between subtrees (before the subtrees).
+            All other subtrees are handed to a pool of workers, the rest of the graph is
+            updated in the calling thread afterwards.
+
+            executor ... "thread" uses a multiprocessing.pool.ThreadPool, which only pays off
+                         if the nodes spend their time in numpy/scipy routines that release
+                         the GIL. "process" uses a multiprocessing.Pool. The workers operate 
+                         on pickled copies of the subtrees, whose state is copied back, so all
+                         their nodes have to be picklable. Subtrees containing shared nodes
+                         or unpicklable nodes are never sent to processes.
+            workers .... Number of workers (default: number of subtrees to update)
+        """
+        if _current_round() != None:
+            return self.update()
+        if executor not in ("thread","process"):
+            raise ValueError("Unknown executor %s, use 'thread' or 'process'."%executor)
+
+        graph = self.calculator_graph()
+        order = self.update_order()
+        node = self
+        while len(set(graph[node])) == 1:
+            node = graph[node][0]
+        subtrees = [ child.update_order() for child in set(graph[node]) ]
+
+        membership = {}
+        for subtree in subtrees:
+            for member in subtree:
+                membership[member] = membership.get(member,0) + 1
+        shared = set( member for member,count in membership.iteritems() if count > 1 )
+
+        _update_round.results = results = {}
+        try:
+            for member in order:
+                if member in shared:
+                    member.update()
+
+            pending = [ subtree for subtree in subtrees if True in [ member.changed for member in subtree ] ]
+            if executor == "process":
+                pending = [ subtree for subtree in pending if not shared.intersection(subtree) and _picklable(subtree) ]
+
+            if len(pending) > 1:
+                if executor == "thread":
+                    from multiprocessing.pool import ThreadPool
+                    pool = ThreadPool(workers or len(pending))
+                    try:
+                        pool.map(lambda subtree: _join_update_round(results,subtree),pending)
+                    finally:
+                        pool.close() ; pool.join()
+                else:
+                    from multiprocessing import Pool
+                    pool = Pool(workers or len(pending))
+                    try:
+                        remote_results = pool.map(_update_subtree,pending)
+                    finally:
+                        pool.close() ; pool.join()
+                    for subtree,remote_result in zip(pending,remote_results):
+                        if remote_result == None:
+                            # The updated subtree could not be sent back, it is updated below
+                            continue
+                        remote_subtree,changed = remote_result
+                        for member,remote,member_changed in zip(subtree,remote_subtree,changed):
+                            # Take over the updated state, but keep the inputs that link the graph
+                            state = remote.__dict__.copy()
+                            state.update(member._input_variables)
+                            state["_input_variables"] = member._input_variables
+                            state["_dirty"]           = 0
+                            member.__dict__.update(state)
+                            results[member] = member_changed
+
+            for member in order:
+                member.update()
+        finally:
+            _update_round.results = None
+        return results[self]
+
+    def __update_node(self):
         changed = self.do_update()
-        for key in self._changes:
-            self._changes[key]=False
+        self.__dict__["_dirty"] = 0
         return changed
+
+
+def _picklable(subtree):
+    """
+        Checks if a subtree can be sent to a worker process of parallel_update.
+    """
+    from cPickle import dumps,HIGHEST_PROTOCOL
+    try:
+        dumps(subtree,HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+def _join_update_round(results,subtree):
+    """
+        Worker for BasicCalculator.parallel_update in thread mode. The worker thread 
+        joins the update round of the calling thread and updates the subtree (a list of
+        nodes in update order) within it.
+    """
+    _update_round.results = results
+    try:
+        for node in subtree:
+            node.update()
+    finally:
+        _update_round.results = None
+
+def _update_subtree(subtree):
+    """
+        Worker for BasicCalculator.parallel_update in process mode. The subtree is a
+        list of nodes in update order, its last entry is the root of the subtree.
+        Returns None if the updated subtree cannot be pickled (e.g. if an output
+        is a lambda), the subtree is then updated by the calling process.
+    """
+    results = subtree[-1]._run_update_round()
+    if not _picklable(subtree):
+        return None
+    return subtree,[ results[node] for node in subtree ]
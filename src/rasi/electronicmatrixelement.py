@@ -39,18 +39,44 @@ def loginterpolate(x,x1,y1,x2,y2):
     return exp(lininterpolate(x,x1,log(y1),x2,log(y2)))
 
 def loginterpolatearray(x,x1,y1,x2,y2):
-    from numpy import zeros
-    result = zeros(y1.shape)
-    for i in xrange(len(y1)):
-        result[i] = loginterpolate(x,x1,y1[i],x2,y2[i])
-    return result
+    from numpy import asarray,where,log,exp
+    y1 = asarray(y1) ; y2 = asarray(y2)
+    # Like loginterpolate, the result is zero where one of the values is zero
+    nonzero = (y1 != 0) & (y2 != 0)
+    logy1 = log(where(nonzero,y1,1.))
+    logy2 = log(where(nonzero,y2,1.))
+    return where(nonzero,exp(lininterpolate(x,x1,logy1,x2,logy2)),0.)
 
 
 class EMF1DPositionInterpolator(BasicCalculator):
+    """
+        Interpolates the reservoirs of an EMF object (see rasi.io) to defect positions 
+        between the simulated ones.
+
+        INPUT PARAMETERS:
+        emf ........................... The EMF object
+        position ...................... The position of the defect or an array of positions
+        interpolation ................. "linear" or "logarithmic" interpolation of the reservoirs
+                                        (default: "linear"). Tunneling factors vary exponentially
+                                        with the position, so "logarithmic" is usually more accurate.
+
+        OUTPUT PARAMETERS:
+        oxidation_reservoir ........... Dictionary reservoir name -> (E,d) where d is an array
+                                        (positions x energies) if position is an array
+        reduction_reservoir ........... Same for the reduction reservoirs
+        Ec, Ev, phi ................... Linearly interpolated band edges and potential (arrays if 
+                                        position is an array)
+
+        The positions and the reservoirs of all defects are stacked into arrays once per
+        EMF object. For lazily read EMF files (see rasi.io.EMFv1LazyDefects), and for 
+        files whose defects have different energy grids, only the defects around the 
+        requested positions are read and stacked.
+    """
     def __init__(self, **kwargs):
         self.init_input_variables(
                  emf      = None,
                  position = None,
+                 interpolation = "linear",
                  )
         self.init_output_variables(
                  oxidation_reservoir = None,
@@ -61,59 +87,94 @@ class EMF1DPositionInterpolator(BasicCalculator):
                  )
         self.set_variables(kwargs)
 
+    def __stack(self,emf,defect_indices):
+        from numpy import array
+        defects = [ emf._defects[i] for i in defect_indices ]
+        first = defects[0]
+
+        reservoirs = []
+        for kind,get in (("Oxidation",lambda defect:defect.oxidation_reservoir),
+                         ("Reduction",lambda defect:defect.reduction_reservoir)):
+            names = sorted(get(first).iterkeys())
+            for defect in defects:
+                if sorted(get(defect).iterkeys()) != names:
+                    raise ValueError("%s reservoirs of EMF defect objects contain different reservoirs"%kind)
+            stacked = {}
+            for name in names:
+                E = get(first)[name][0]
+                for defect in defects:
+                    E_other = get(defect)[name][0]
+                    if len(E_other) != len(E) or (E_other != E).any():
+                        raise ValueError("Energy grids of EMF defect objects don't match")
+                stacked[name] = E,array([ get(defect)[name][1] for defect in defects ])
+            reservoirs.append(stacked)
+
+        bands = [ array([ getattr(defect,band) for defect in defects ]) for band in ("Ec","Ev","phi") ]
+        return reservoirs,bands
+
+    def __table(self):
+        from numpy import argsort
+        from rasi.io import EMFv1LazyDefects
+        emf   = self.emf
+        table = self.__dict__.get("_emf_table")
+        if table == None or table[0] is not emf:
+            positions = emf.positions()
+            order = argsort(positions,kind="mergesort")
+            stacked = None
+            if not isinstance(emf._defects,EMFv1LazyDefects):
+                try:
+                    stacked = self.__stack(emf,order)
+                except ValueError:
+                    # The defects do not share their reservoirs or energy grids, so only
+                    # the defects around the requested positions are stacked (and checked)
+                    stacked = None
+            table = emf,positions[order],order,stacked
+            self.__dict__["_emf_table"] = table
+        return table
 
     def do_update(self):
-        from numpy import vectorize
+        from numpy import asarray,atleast_1d,searchsorted,unique,concatenate,newaxis
         if self.changed:
-            x = self.position
-
-            defects = [ defect for defect in self.emf._defects ]
-            #defects.sort(key=(lambda defect: float(defect._info)))
-
-            positions = [ float(defect._info) for defect in self.emf._defects ]
-
-            if not (positions[0] < x and x < positions[-1]):
-                raise ValueError("Defect position %g outside of simulated interval (%g,%g)"%(x,positions[0],positions[-1]))
-
-            i_lower  = None
-            i_higher = None
-            for i,position in enumerate(positions):
-                if x < position:
-                    i_higher = i
-                    i_lower  = i-1
-                    break
-
-            if defects[i_lower].oxidation_reservoir.keys() != defects[i_higher].oxidation_reservoir.keys():
-                raise ValueError("Oxidation reservoirs of EMF defect objects contain different reservoirs")
-            if defects[i_lower].reduction_reservoir.keys() != defects[i_higher].reduction_reservoir.keys():
-                raise ValueError("Reduction reservoirs of EMF defect objects contain different reservoirs")
-
-            oxidation_reservoir = {}
-            for name in defects[i_lower].oxidation_reservoir.iterkeys():
-                E_lower ,d_lower   = defects[i_lower].oxidation_reservoir[name]
-                E_higher,d_higher  = defects[i_higher].oxidation_reservoir[name]
-                x_lower  = positions[i_lower]
-                x_higher = positions[i_higher] 
-                if (E_lower != E_higher).any():
-                    raise ValueError("Energy grids of EMF defect objects don't match")
-                oxidation_reservoir[name] = E_lower,lininterpolate(x,x_lower,d_lower,x_higher,d_higher)
-
-            reduction_reservoir = {}
-            for name in defects[i_lower].reduction_reservoir.iterkeys():
-                E_lower ,d_lower   = defects[i_lower].reduction_reservoir[name]
-                E_higher,d_higher  = defects[i_higher].reduction_reservoir[name]
-                x_lower  = positions[i_lower]
-                x_higher = positions[i_higher] 
-                if (E_lower != E_higher).any():
-                    raise ValueError("Energy grids of EMF defect objects don't match")
-                reduction_reservoir[name] = E_lower,lininterpolate(x,x_lower,d_lower,x_higher,d_higher)
-
-            self.internal_oxidation_reservoir = oxidation_reservoir
-            self.internal_reduction_reservoir = reduction_reservoir
-
-            self.internal_Ec  = lininterpolate(x,x_lower,defects[i_lower].Ec ,x_higher,defects[i_higher].Ec )
-            self.internal_Ev  = lininterpolate(x,x_lower,defects[i_lower].Ev ,x_higher,defects[i_higher].Ev )
-            self.internal_phi = lininterpolate(x,x_lower,defects[i_lower].phi,x_higher,defects[i_higher].phi)
+            emf,positions,order,stacked = self.__table()
+            x = atleast_1d(asarray(self.position,dtype=float))
+
+            outside = ~((positions[0] < x) & (x < positions[-1]))
+            if outside.any():
+                raise ValueError("Defect position %g outside of simulated interval (%g,%g)"%(x[outside][0],positions[0],positions[-1]))
+
+            i_higher = searchsorted(positions,x,side="right")
+            i_lower  = i_higher-1
+            x_lower  = positions[i_lower]
+            x_higher = positions[i_higher]
+
+            if stacked == None:
+                # Only read the defects that are actually needed
+                rows = unique(concatenate((i_lower,i_higher)))
+                stacked = self.__stack(emf,order[rows])
+                i_lower  = searchsorted(rows,i_lower)
+                i_higher = searchsorted(rows,i_higher)
+            (oxidation_stack,reduction_stack),bands = stacked
+
+            if self.interpolation == "linear":
+                interpolate_reservoir = lininterpolate
+            elif self.interpolation == "logarithmic":
+                interpolate_reservoir = loginterpolatearray
+            else:
+                raise ValueError("Unknown interpolation '%s'"%self.interpolation)
+
+            single = asarray(self.position).ndim == 0
+            def interpolate(d):
+                result = interpolate_reservoir(x[:,newaxis],x_lower[:,newaxis],d[i_lower],x_higher[:,newaxis],d[i_higher])
+                return result[0] if single else result
+
+            self.internal_oxidation_reservoir = dict( (name,(E,interpolate(d))) for name,(E,d) in oxidation_stack.iteritems() )
+            self.internal_reduction_reservoir = dict( (name,(E,interpolate(d))) for name,(E,d) in reduction_stack.iteritems() )
+
+            [Ec,Ev,phi] = [ lininterpolate(x,x_lower,band[i_lower],x_higher,band[i_higher]) for band in bands ]
+            if single:
+                Ec,Ev,phi = Ec[0],Ev[0],phi[0]
+            self.internal_Ec  = Ec
+            self.internal_Ev  = Ev
+            self.internal_phi = phi
             return True
         return False
-
@@ -62,7 +62,17 @@ class EMFv1:
         self._type = None
         self._defects = []
         
-    def read(self,emffile):
+    def read(self,emffile,lazy=False,max_cached_defects=16):
+        """
+            Reads the defects from emffile. With lazy=True, only an index of the 
+            defect blocks is built (or loaded, see EMFv1LazyDefects) and the 
+            defects are parsed on demand.
+        """
+        if lazy:
+            [self._dimensionality,self._devicesimulator,self._theorylevel,self._type] = emffile.readline().split()
+            ndefects = int(emffile.readline())
+            self._defects = EMFv1LazyDefects(emffile,ndefects,max_cached_defects)
+            return
         [self._dimensionality,self._devicesimulator,self._theorylevel,self._type] = emffile.next().split()
         ndefects = int(emffile.next())
         for i in range(ndefects):
@@ -70,16 +80,228 @@ class EMFv1:
             defect.read_from_stream(emffile)
             self._defects.append(defect)
 
-def EMF(emffile):
+    def positions(self):
+        """
+            Returns the positions (the info fields) of all defects as an array.
+        """
+        from numpy import array
+        if isinstance(self._defects,EMFv1LazyDefects):
+            return self._defects.positions
+        return array([ float(defect._info) for defect in self._defects ])
+
+class EMFv1LazyDefects(object):
+    """
+        Sequence of the defects in an EMFv1 text file that are parsed on demand.
+
+        On construction, the file is scanned once for the byte offsets and 
+        positions of the defect blocks. This index is saved next to the file
+        (<filename>.index.npz) and reused as long as size and modification time
+        of the file match, so later runs do not need to scan the file at all.
+        At most max_cached_defects parsed defects are kept (LRU).
+    """
+    def __init__(self,emffile,ndefects,max_cached_defects=16):
+        from collections import OrderedDict
+        self._file               = emffile
+        self.max_cached_defects  = max_cached_defects
+        self.__cached            = OrderedDict()
+        index = self.__load_index()
+        if index == None:
+            index = self.__scan(ndefects)
+            self.__save_index(index)
+        self.offsets,self.positions = index
+        if len(self.offsets) != ndefects:
+            raise ValueError("EMF file %s: index does not match the number of defects"%emffile.name)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("defect index out of range")
+        if i in self.__cached:
+            defect = self.__cached.pop(i)
+        else:
+            self._file.seek(self.offsets[i])
+            defect = EMFv1Defect(iter(self._file.readline,""))
+            if len(self.__cached) >= self.max_cached_defects:
+                self.__cached.popitem(last=False)
+        self.__cached[i] = defect
+        return defect
+
+    def __scan(self,ndefects):
+        from itertools import islice
+        from numpy import array
+        readline = self._file.readline
+        offsets   = []
+        positions = []
+        for i in xrange(ndefects):
+            offsets.append(self._file.tell())
+            positions.append(float(readline()))
+            readline()
+            [noxi,nred] = [ int(val) for val in readline().split() ]
+            for j in xrange(noxi+nred):
+                readline()
+                nlines = int(readline())
+                for line in islice(iter(readline,""),nlines):
+                    pass
+        return array(offsets,dtype=int),array(positions)
+
+    def __index_filename(self):
+        import os
+        name = getattr(self._file,"name",None)
+        if name == None or not os.path.isfile(name):
+            return None,None
+        stat = os.stat(name)
+        return name+".index.npz",(stat.st_size,stat.st_mtime)
+
+    def __load_index(self):
+        from numpy import load
+        filename,stamp = self.__index_filename()
+        if filename == None:
+            return None
+        try:
+            index = load(filename)
+            try:
+                if tuple(index["stamp"]) != stamp:
+                    return None
+                return index["offsets"],index["positions"]
+            finally:
+                index.close()
+        except (IOError,KeyError,ValueError):
+            return None
+
+    def __save_index(self,index):
+        from numpy import savez
+        filename,stamp = self.__index_filename()
+        if filename == None:
+            return
+        try:
+            with open(filename,"wb") as indexfile:
+                savez(indexfile,offsets=index[0],positions=index[1],stamp=stamp)
+        except IOError:
+            # The index is only an optimization
+            pass
+
+class EMFv1Binary(EMFv1):
+    """
+        EMFv1 data stored in the binary sibling of the EMFILE format.
+
+        The file starts with the line "EMFBINARY v1 <offset>", followed by a JSON
+        header describing the defects, padded with blanks up to <offset>. From
+        there on the file contains the reservoirs as contiguous blocks of
+        little-endian float64, first the energies, then the values. The file is
+        memory-mapped and the reservoirs of the defects are views into the map,
+        so nothing is read before it is actually used.
+
+        Convert text files with convert_EMFv1_to_binary. EMF() recognizes both
+        formats.
+    """
+    magic  = "EMFBINARY v1"
+    prefix = "%s %%16d\n"%magic
+
+    def read(self,emffile):
+        import json
+        from numpy import memmap,zeros
+        data_offset = int(emffile.readline().split()[2])
+        header      = json.loads(emffile.read(data_offset-emffile.tell()))
+        self._dimensionality  = str(header["dimensionality"])
+        self._devicesimulator = str(header["devicesimulator"])
+        self._theorylevel     = str(header["theorylevel"])
+        self._type            = str(header["type"])
+
+        if header["size"] > 0:
+            data = memmap(emffile.name,dtype="<f8",mode="r",offset=data_offset,shape=(header["size"],))
+        else:
+            data = zeros(0)
+        def reservoir_set(offset,n):
+            block = data[offset:offset+2*n].reshape(2,n)
+            return block[0],block[1]
+
+        for entry in header["defects"]:
+            defect = EMFv1Defect()
+            defect._info = str(entry["info"])
+            defect.phi   = entry["phi"]
+            defect.Ec    = entry["Ec"]
+            defect.Ev    = entry["Ev"]
+            for setname,offset,n in entry["oxidation"]:
+                defect.oxidation_reservoir[str(setname)] = reservoir_set(offset,n)
+            for setname,offset,n in entry["reduction"]:
+                defect.reduction_reservoir[str(setname)] = reservoir_set(offset,n)
+            self._defects.append(defect)
+
+    @classmethod
+    def write(cls,emf,filename):
+        """
+            Writes the EMFv1 object emf to filename in the binary format.
+        """
+        import json
+        from numpy import asarray
+        blocks  = []
+        size    = 0
+        defects = []
+        for defect in emf._defects:
+            entry = { "info":defect._info, "phi":defect.phi, "Ec":defect.Ec, "Ev":defect.Ev }
+            for key,reservoir in (("oxidation",defect.oxidation_reservoir),("reduction",defect.reduction_reservoir)):
+                entry[key] = []
+                for setname in sorted(reservoir.iterkeys()):
+                    E,d = reservoir[setname]
+                    entry[key].append((setname,size,len(E)))
+                    blocks.append(asarray(E,dtype="<f8")); blocks.append(asarray(d,dtype="<f8"))
+                    size += 2*len(E)
+            defects.append(entry)
+        header = json.dumps({ "dimensionality"  : emf._dimensionality,
+                              "devicesimulator" : emf._devicesimulator,
+                              "theorylevel"     : emf._theorylevel,
+                              "type"            : emf._type,
+                              "size"            : size,
+                              "defects"         : defects })
+        # Align the data to 8 bytes
+        data_offset = len(cls.prefix%0) + len(header)
+        data_offset += -data_offset%8
+        with open(filename,"wb") as target:
+            target.write(cls.prefix%data_offset)
+            target.write(header.ljust(data_offset-len(cls.prefix%0)))
+            for block in blocks:
+                block.tofile(target)
+
+def convert_EMFv1_to_binary(source,target):
+    """
+        Converts the EMFv1 text file source to the binary format (see EMFv1Binary)
+        and writes it to target.
+    """
+    emf = EMF(source)
+    if not isinstance(emf,EMFv1):
+        raise ValueError("EMF file %s: not an EMFv1 file"%source)
+    EMFv1Binary.write(emf,target)
+
+def EMF(emffile,lazy=False,max_cached_defects=16):
+    """
+        Reads the EMF file emffile (a filename or an open file). Text files can be
+        read lazily, i.e. defects are only parsed when accessed (see 
+        EMFv1LazyDefects). Binary files (see EMFv1Binary) are always mapped.
+    """
     if type(emffile) == str:
         emffile = open(emffile)
-    title = emffile.next()
+    if emffile.read(len(EMFv1Binary.magic)) == EMFv1Binary.magic:
+        emffile.seek(0)
+        emf = EMFv1Binary()
+        emf._filename = emffile.name
+        emf.read(emffile)
+        return emf
+    emffile.seek(0)
+    title = emffile.readline()
     if not title.startswith("EMFILE"):
         raise ValueError("EMF file %s: invalid format"%emffile.name)
     if int(title.split()[1][1:]) == 1:
         emf = EMFv1()
         emf._filename = emffile.name
-        emf.read(emffile)
+        emf.read(emffile,lazy=lazy,max_cached_defects=max_cached_defects)
         return emf
     else:
         raise ValueError("EMF version not recognized.")
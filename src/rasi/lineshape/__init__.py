@@ -41,6 +41,9 @@
 
 from tools     import calc_modal_vector, \
                       LineShapeBuffer, \
+                      TemperatureLineShapeBuffer, \
+                      LinearInterpolant, \
+                      adaptive_grid, \
                       LineShapeEnergyCorrector
 
 from overlaps import DiscreteLineShape, \
@@ -48,3 +51,7 @@ from overlaps import DiscreteLineShape, \
 
 from classical import ClassicalLineShape
 from schmidt   import SchmidtOverlaps
+from numeric_overlaps import NumericOverlaps
+from multimode import MultiModeLineShape
+from generating_function import GeneratingFunctionLineShape
+from cache     import OverlapCache
@@ -0,0 +1,195 @@
+"""
+    Reliability Analysis of Semiconductor Interfaces -- Result cache for overlap providers
+    --------------------------------------------------------------------------------------
+
+    Overlap matrices only depend on a handful of parameters, but they are
+    recalculated over and over again for defects that share these parameters.
+    An OverlapCache stores the results of overlap providers under a hash of
+    their parameters, in memory and optionally on disk.
+
+"""
+###############################################################################
+#
+#  RASI ... Reliability Analysis of Semiconductor Interfaces
+#
+#  (c) 2013-2014 Franz Schanovsky
+#
+#  This project is dedicated to the loving memory of Margarete and Johann
+#  Mittermayr.
+#
+###############################################################################
+#
+#    This software is licensed under the EUPL V 1.1
+#
+#    This software is provided "as is" without warranty of any kind, see the
+#    respective section in the EUPL. USE AT YOUR OWN RISK.
+#
+###############################################################################
+
+class OverlapCache(object):
+    """
+        Content-addressed cache for the results of overlap providers.
+
+        A result is a dictionary of named arrays (numpy arrays or scipy.sparse
+        matrices), stored under a key that is calculated from the name of the
+        provider and all parameters the result depends on:
+
+            cache = OverlapCache(directory="overlap_cache")
+            key   = cache.key("SchmidtOverlaps",mass=mass, ...)
+            result = cache.fetch(key,calculate)
+
+        where calculate() is only called if the result is neither in memory nor
+        on disk. The in-memory part is a LRU cache limited to max_bytes. If a
+        directory is given, every result is also written there (one subdirectory
+        per key, one .npy file per array) and read back memory-mapped. The arrays
+        handed out by the cache are read-only.
+
+        Plug it into an overlap provider via its "cache" input parameter (see
+        SchmidtOverlaps).
+    """
+    # Increase if the stored format or the meaning of the keys changes
+    version = 1
+
+    def __init__(self,directory=None,max_bytes=256*2**20):
+        from collections import OrderedDict
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.__entries = OrderedDict()
+        self.__bytes   = 0
+        if directory != None:
+            import os
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def key(self,provider,**parameters):
+        """
+            Calculates the key for the result of the provider with the given parameters.
+            The parameters have to be reproducibly representable by repr().
+        """
+        from hashlib import sha1
+        return sha1(repr((self.version,provider,sorted(parameters.items())))).hexdigest()
+
+    def fetch(self,key,calculate):
+        """
+            Returns the result stored under key. If there is none, it is calculated by
+            calling calculate() and stored.
+        """
+        result = self.get(key)
+        if result == None:
+            self.misses += 1
+            result = self.put(key,calculate())
+        else:
+            self.hits += 1
+        return result
+
+    def get(self,key):
+        """
+            Returns the result stored under key or None.
+        """
+        if key in self.__entries:
+            result = self.__entries.pop(key)
+            self.__entries[key] = result
+            return result
+        if self.directory != None:
+            result = self.__load(key)
+            if result != None:
+                self.__remember(key,result)
+                return result
+        return None
+
+    def put(self,key,result):
+        """
+            Stores result under key and returns the (read-only) stored version.
+        """
+        result = dict( (name,self.__readonly(value)) for name,value in result.iteritems() )
+        if self.directory != None:
+            self.__save(key,result)
+        self.__remember(key,result)
+        return result
+
+    def clear(self):
+        """
+            Clears the in-memory part of the cache.
+        """
+        self.__entries.clear()
+        self.__bytes = 0
+
+    @staticmethod
+    def __readonly(value):
+        from scipy.sparse import issparse,csr_matrix
+        from numpy import array
+        if issparse(value):
+            value = csr_matrix(value)
+            for component in (value.data,value.indices,value.indptr):
+                component.flags.writeable = False
+        else:
+            value = array(value)
+            value.flags.writeable = False
+        return value
+
+    @staticmethod
+    def __nbytes(result):
+        from scipy.sparse import issparse
+        nbytes = 0
+        for value in result.itervalues():
+            if issparse(value):
+                nbytes += value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+            else:
+                nbytes += value.nbytes
+        return nbytes
+
+    def __remember(self,key,result):
+        nbytes = self.__nbytes(result)
+        if nbytes > self.max_bytes:
+            return
+        self.__entries[key] = result
+        self.__bytes += nbytes
+        while self.__bytes > self.max_bytes:
+            _,oldest = self.__entries.popitem(last=False)
+            self.__bytes -= self.__nbytes(oldest)
+
+    def __save(self,key,result):
+        import os,tempfile,shutil
+        from numpy import save,array
+        from scipy.sparse import issparse
+        target = os.path.join(self.directory,key)
+        if os.path.isdir(target):
+            return
+        # Write into a temporary directory first, so concurrent runs never see partial results
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        try:
+            for name,value in result.iteritems():
+                if issparse(value):
+                    save(os.path.join(tmp,name+".csr_data.npy")   ,value.data)
+                    save(os.path.join(tmp,name+".csr_indices.npy"),value.indices)
+                    save(os.path.join(tmp,name+".csr_indptr.npy") ,value.indptr)
+                    save(os.path.join(tmp,name+".csr_shape.npy")  ,array(value.shape))
+                else:
+                    save(os.path.join(tmp,name+".npy"),value)
+            os.rename(tmp,target)
+        except OSError:
+            # Someone else was faster
+            shutil.rmtree(tmp,ignore_errors=True)
+
+    def __load(self,key):
+        import os
+        from numpy import load
+        from scipy.sparse import csr_matrix
+        source = os.path.join(self.directory,key)
+        if not os.path.isdir(source):
+            return None
+        arrays = {}
+        for filename in os.listdir(source):
+            if filename.endswith(".npy"):
+                arrays[filename[:-4]] = load(os.path.join(source,filename),mmap_mode="r")
+        result = {}
+        for name,value in arrays.iteritems():
+            if name.endswith(".csr_data"):
+                name = name[:-9]
+                result[name] = csr_matrix((value,arrays[name+".csr_indices"],arrays[name+".csr_indptr"]),
+                                          shape=tuple(arrays[name+".csr_shape"]))
+            elif ".csr_" not in name:
+                result[name] = value
+        return result
@@ -18,6 +18,18 @@
 
 from rasi.base import BasicCalculator
 
+class LineShapeFunction(object):
+    """
+        The oxidation/reduction outputs of ClassicalLineShape. Unlike the bound
+        methods they wrap, these objects can be pickled (e.g. by parallel_update).
+    """
+    def __init__(self,lineshape,method):
+        self.lineshape = lineshape
+        self.method    = method
+
+    def __call__(self,E):
+        return getattr(self.lineshape,self.method)(E)
+
 class ClassicalLineShape(BasicCalculator):
     """
         ClassicalLineShape calculates line shapes assuming a classical one-dimensional
@@ -56,6 +68,7 @@ class ClassicalLineShape(BasicCalculator):
                    oxidation = None,
                    reduction = None
                    )           
+        self.set_variables(kwargs)
 
     @staticmethod
     def __partitionfunction(Momega2,T):
@@ -66,70 +79,100 @@ class ClassicalLineShape(BasicCalculator):
         return sqrt(2*pi*kB*T/Momega2)
 
     def do_update(self):
-        from numpy import vectorize
         if self.changed:
-            self.internal_oxidation = vectorize(self._oxidation)
-            self.internal_reduction = vectorize(self._reduction)
+            self.internal_oxidation = LineShapeFunction(self,"_oxidation")
+            self.internal_reduction = LineShapeFunction(self,"_reduction")
             return True
         return False
 
+    def __partition_functions(self):
+        """ 
+            The partition functions of both states, (4.79) and (4.80) in my thesis. 
+            They are cached, keyed by the inputs they depend on, so they are also 
+            correct if the inputs were changed without an update.
+        """
+        key = (self.k_occupied,self.k_unoccupied,self.temperature)
+        cached = self.__dict__.get("_partition_functions")
+        if cached == None or cached[0] != key:
+            T = self.temperature
+            cached = key,(self.__partitionfunction(2*self.k_occupied,T),
+                          self.__partitionfunction(2*self.k_unoccupied,T))
+            self.__dict__["_partition_functions"] = cached
+        return cached[1]
+
     def crossings(self,E):
-        from scipy import sqrt
         """ Calculation of the intersection coordinates for the
             parabolas. (4.82) in my thesis. 
+
+            E may be an array, the crossings are returned as two arrays
+            of the same shape which contain nan where the parabolas have
+            no real-valued crossing. For equal spring constants there is
+            only one crossing, the second array is all nan then.
         """
+        from numpy import asarray,sqrt,where,nan,zeros
         # Typo alert equation (4.82): Q' in the square root should be Q'**2
         k0 = self.k_occupied; kp = self.k_unoccupied ; shift = self.equilibrium_shift
         lvl = self.thermodynamic_level
+        E = asarray(E,dtype=float)
+
+        if k0 == kp:
+            # The parabolas only differ by a linear term
+            return shift/2. + (E-lvl)/(2*kp*shift), zeros(E.shape) + nan
 
         # The expressions are of the form ( a +/- sqrt(b) ) / D
         a = kp*shift
         b = k0*kp*shift**2 +(k0-kp)*(E-lvl)
         D = kp-k0
 
-        if b < 0:
-            raise ValueError("Parabolas have no real-valued crossings")
-        return ( ( a + sqrt(b) ) / D, (a - sqrt(b) ) / D )
+        root = sqrt(where(b < 0,nan,b))
+        return ( ( a + root ) / D, (a - root ) / D )
 
-        
-    # To all Java/C++/... programmers: remember that those methods are DETACHABLE!
-    def _oxidation(self,E):
-        from scipy import exp,sqrt,pi
+    def __lineshape(self,E,T,Z,k,Q0):
+        """ Sum over the crossings of exp(-k*(Q-Q0)**2/(kB*T))/|dV/dQ| / Z, T and
+            Z may be arrays of temperatures and partition functions, which then
+            form the first axis of the result.
+        """
+        from numpy import asarray,exp,where,isnan,zeros
         from scipy.constants import k as kB
-        T = self.temperature
         k0 = self.k_occupied     ; kp = self.k_unoccupied
-        shift = self.equilibrium_shift ; lvl = self.thermodynamic_level
+        shift = self.equilibrium_shift
         Momega20 = 2*k0    ; Momega2P = 2*kp
-        Z0 = self.__partitionfunction(Momega20,T)
-
-        try:
-            Q1,Q2 = self.crossings(E)
-        except ValueError:
-            return 0.
-        denom1 = abs(Momega20*Q1+Momega2P*(shift-Q1))
-        denom2 = abs(Momega20*Q2+Momega2P*(shift-Q2))
+        E = asarray(E,dtype=float)
+        T = asarray(T,dtype=float) ; Z = asarray(Z,dtype=float)
+        # Temperatures along the first axis
+        T = T.reshape(T.shape+(1,)*E.ndim) ; Z = Z.reshape(T.shape)
+
+        value = zeros(T.shape[:T.ndim-E.ndim]+E.shape)
+        for Q in self.crossings(E):
+            real  = ~isnan(Q)
+            Q     = where(real,Q,0.)
+            denom = abs(Momega20*Q+Momega2P*(shift-Q))
+            value += where(real,exp(-k*(Q-Q0)**2/(kB*T))/denom,0.)
+        return value/Z
 
+    # To all Java/C++/... programmers: remember that those methods are DETACHABLE!
+    def _oxidation(self,E):
+        Z0,ZP = self.__partition_functions()
         # (4.83) Beware of another typo!
-        return Z0**-1*(exp(-k0*Q1**2/(kB*T))/denom1+exp(-k0*Q2**2/(kB*T))/denom2)
+        return self.__lineshape(E,self.temperature,Z0,self.k_occupied,0.)[()]
     
     def _reduction(self,E):
-        from scipy import exp,sqrt,pi
-        from scipy.constants import k as kB
-        T = self.temperature
-        k0 = self.k_occupied     ; kp = self.k_unoccupied
-        shift = self.equilibrium_shift ; lvl = self.thermodynamic_level
-        Momega20 = 2*k0    ; Momega2P = 2*kp
-        # First the partition function (4.80) in my thesis
-        ZP = self.__partitionfunction(Momega2P,T)
-
-        try:
-            Q1,Q2 = self.crossings(E)
-        except ValueError:
-            return 0.
-
-        denom1 = abs(Momega20*Q1+Momega2P*(shift-Q1))
-        denom2 = abs(Momega20*Q2+Momega2P*(shift-Q2))
-
+        Z0,ZP = self.__partition_functions()
         # (4.84) Beware of another typo!
-        return ZP**-1*(exp(-kp*(Q1-shift)**2/(kB*T))/denom1+exp(-kp*(Q2-shift)**2/(kB*T))/denom2)
-
+        return self.__lineshape(E,self.temperature,ZP,self.k_unoccupied,self.equilibrium_shift)[()]
+
+    def oxidation_sweep(self,E,temperatures):
+        """ Oxidation lineshape for an array of temperatures, shape (len(temperatures),)+E.shape """
+        from numpy import asarray
+        self.update()
+        temperatures = asarray(temperatures,dtype=float)
+        Z0 = self.__partitionfunction(2*self.k_occupied,temperatures)
+        return self.__lineshape(E,temperatures,Z0,self.k_occupied,0.)
+
+    def reduction_sweep(self,E,temperatures):
+        """ Reduction lineshape for an array of temperatures, shape (len(temperatures),)+E.shape """
+        from numpy import asarray
+        self.update()
+        temperatures = asarray(temperatures,dtype=float)
+        ZP = self.__partitionfunction(2*self.k_unoccupied,temperatures)
+        return self.__lineshape(E,temperatures,ZP,self.k_unoccupied,self.equilibrium_shift)
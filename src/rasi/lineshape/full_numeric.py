@@ -17,13 +17,23 @@
 ###############################################################################
 
 
-from overlaps.units import *
-from overlaps.constants import *
+from scipy.constants import hbar as hred, eV
 from tools import write_data
 
-def schroedinger_solve(dx,V,m,):
-    from scipy        import zeros
-    from scipy.linalg import eigh
+def schroedinger_solve(dx,V,m,E_max=None,tridiagonal=True,n_states=None):
+    """
+        Solves the 1D Schroedinger equation for the potential V sampled with the
+        spacing dx using finite differences. Only the eigenvalues below E_max are
+        calculated if it is given, only the lowest n_states eigenvalues if that 
+        is given. The Hamiltonian is tridiagonal, so by default
+        it is never built as a dense matrix (tridiagonal=False uses the old dense
+        solver).
+
+        Returns the eigenvalues as an array and the eigenvectors as the rows of
+        an array.
+    """
+    from scipy        import zeros,ones,asarray,arange
+    from scipy.linalg import eigh,eigh_tridiagonal
     # This is a bit weak, interpolation on the finest grid
     # dx = min( xi-xi_old for xi,xi_old in zip(x[1:],x[0:-1]))
     # xmin = x[0]
@@ -34,28 +44,45 @@ def schroedinger_solve(dx,V,m,):
     # V = Vint
     # x = xint
 
+    V  = asarray(V,dtype=float)
     nx = len(V)
-    H = zeros([nx,nx])
-
-    for i in range(nx):
-        if i > 0:
-            H[i,i-1] = -hred**2/(2*dx**2*m)
-        H[i,i] = hred**2/(dx**2*m)+V[i]
-        if i < nx-1:
-            H[i,i+1] = -hred**2/(2*dx**2*m)
-
-    Ew,v = eigh(H)
-
-    Ew = Ew.tolist()
-    v  = v.transpose().tolist()
-    return Ew,v
+    diagonal     = hred**2/(dx**2*m)+V
+    off_diagonal = -hred**2/(2*dx**2*m)*ones(nx-1)
+
+    if tridiagonal:
+        if n_states != None:
+            Ew,v = eigh_tridiagonal(diagonal,off_diagonal,select="i",select_range=(0,min(n_states,nx)-1))
+            if E_max != None:
+                v  = v[:,Ew <= E_max]
+                Ew = Ew[Ew <= E_max]
+        elif E_max == None:
+            Ew,v = eigh_tridiagonal(diagonal,off_diagonal)
+        else:
+            # The kinetic energy is positive, so all eigenvalues are above min(V)
+            Ew,v = eigh_tridiagonal(diagonal,off_diagonal,select="v",select_range=(V.min(),E_max))
+    else:
+        H = zeros([nx,nx])
+        i = arange(nx)
+        H[i,i] = diagonal
+        H[i[1:],i[:-1]] = off_diagonal
+        H[i[:-1],i[1:]] = off_diagonal
+        Ew,v = eigh(H)
+        if n_states != None:
+            Ew,v = Ew[:n_states],v[:,:n_states]
+        if E_max != None:
+            v  = v[:,Ew <= E_max]
+            Ew = Ew[Ew <= E_max]
+
+    return Ew,v.transpose()
 
 def schroedinger_solve_bound(dx,pot,m):
-    from scipy import array
-    (Ew,wave) = schroedinger_solve(dx,pot,m)
-    Vmax = max(pot)
-    Ew   = [ E for E in Ew if E < Vmax ]
-    wave = [ array(w) for E,w in zip(Ew,wave) if E < Vmax ]
+    from scipy import asarray
+    pot  = asarray(pot,dtype=float)
+    Vmax = pot.max()
+    (Ew,wave) = schroedinger_solve(dx,pot,m,E_max=Vmax)
+    # select_range includes Vmax itself
+    bound = Ew < Vmax
+    Ew,wave = Ew[bound],wave[bound]
     print "%d bound Eigenvalues: min = %f eV, max = %f eV"%(
                               len(wave),min(Ew)/eV,max(Ew)/eV)
     return (Ew,wave)
@@ -75,8 +102,7 @@ def parabolic_overlaps(
                         prefix=None,  # Prefix for output
                         echo=True     # Report status to stdout
                         ):
-    from overlaps.tools import gen_grid
-    from scipy import matrix
+    from scipy import arange,floor,dot
     if echo:
         print 
         print "************************************************************************"
@@ -91,13 +117,13 @@ def parabolic_overlaps(
                    x_f_0 - x_f_range, x_f_0 + x_f_range ]
     x_left  = min(boundaries)
     x_right = max(boundaries)
-    v_x = gen_grid(x_left,x_right,dx)
+    v_x = x_left + arange(int(floor((x_right-x_left)/dx))+1)*dx
 
     if echo:
         print "Setting up potentials..."
 
-    pot_i = [ k_i*(x-x_i_0)**2 for x in v_x ]
-    pot_f = [ k_f*(x-x_f_0)**2 for x in v_x ]
+    pot_i = k_i*(v_x-x_i_0)**2
+    pot_f = k_f*(v_x-x_f_0)**2
 
     if prefix != None:
         write_data(prefix+"_potentials.dat",v_x,pot_i,pot_f)
@@ -120,11 +146,6 @@ def parabolic_overlaps(
     
     if echo:
         print "Calculating overlaps"
-    S = []
-    for wave_init in wave_i:
-        S_i = []
-        for wave_final in wave_f:
-            S_i.append((wave_init*wave_final).sum()**2)
-        S.append(S_i)
+    S = dot(wave_i,wave_f.transpose())**2
     return Ew_i,Ew_f,S
 
@@ -0,0 +1,182 @@
+"""
+    Reliability Analysis of Semiconductor Interfaces -- Generating function lineshape
+    ---------------------------------------------------------------------------------
+
+    The lineshape of two harmonic oscillators with different frequencies and
+    displaced equilibrium coordinates can be calculated from its generating
+    function in the time domain (Kubo, Lax), which has a closed form. This
+    avoids the sum over states, whose cost grows with the number of thermally
+    populated states.
+
+"""
+###############################################################################
+#
+#  RASI ... Reliability Analysis of Semiconductor Interfaces
+#
+#  (c) 2013-2014 Franz Schanovsky
+#
+#  This project is dedicated to the loving memory of Margarete and Johann
+#  Mittermayr.
+#
+###############################################################################
+#
+#    This software is licensed under the EUPL V 1.1
+#
+#    This software is provided "as is" without warranty of any kind, see the
+#    respective section in the EUPL. USE AT YOUR OWN RISK.
+#
+###############################################################################
+
+from rasi.base import BasicCalculator
+
+def harmonic_trace(alpha_1,omega_1,tau_1,alpha_2,omega_2,tau_2,shift):
+    """
+        Returns the logarithm of Tr[exp(-H_1 tau_1/hbar) exp(-H_2 tau_2/hbar)] for
+        two harmonic oscillators with alpha = m*omega/hbar, whose minima are shift
+        apart, for arrays of complex (imaginary) times tau_1 and tau_2. The energies
+        include the zero point energies. The arrays have to be sampled densely
+        enough around tau = 0 so the branch of the square root can be followed.
+    """
+    from numpy import tanh,cosh,log,abs,angle,unwrap,argmin
+    t_1 = tanh(omega_1*tau_1/2) ; t_2 = tanh(omega_2*tau_2/2)
+    # 1-tanh^2 = 1/cosh^2 does not lose the small values at low temperatures
+    z = alpha_1*alpha_2/(4*cosh(omega_1*tau_1/2)**2*cosh(omega_2*tau_2/2)**2
+                         *(alpha_1*t_1+alpha_2*t_2)*(alpha_1*t_2+alpha_2*t_1))
+    # The square root is continued along the times, starting from the real value at
+    # the sample closest to zero
+    phase = angle(z)
+    i0 = argmin(abs(tau_1.imag)+abs(tau_2.imag))
+    phase[i0:]   = unwrap(phase[i0:])
+    phase[:i0+1] = unwrap(phase[i0::-1])[::-1]
+    return .5*(log(abs(z))+1j*phase) - alpha_1*alpha_2*shift**2*t_1*t_2/(alpha_1*t_1+alpha_2*t_2)
+
+class GeneratingFunctionLineShape(BasicCalculator):
+    """
+        GeneratingFunctionLineShape calculates the smeared lineshape of two
+        displaced harmonic oscillators with different frequencies by FFT of the
+        closed-form generating function. It takes the same parameters as
+        SchmidtOverlaps, but its cost only depends on the energy grid, not on
+        the number of vibrational states. The smearing is a Gaussian, as in
+        SmearedLineShape, and is applied in the time domain.
+
+        The result is buffered on the energy grid and can directly be used as the
+        lineshape of a FullNMPTransition.
+
+        INPUT PARAMETERS:
+        ----------------
+
+        omega_occupied .................. Angular oscillation frequency for the occupied state
+        omega_unoccupied ................ Angular oscillation frequency for the unoccupied state
+        mass ............................ Modal mass
+        equilibrium_shift ............... Shift between the equilibrium coordinates of the two states
+        thermodynamic_level ............. Thermodynamic level
+        temperature ..................... Temperature
+        smearing ........................ Standard deviation of the Gaussian smearing
+        energy_range .................... (E_min,E_max) of the energy grid. If None, it is estimated
+                                          from the relaxation energies, the temperature and the
+                                          smearing (default: None)
+        energy_step ..................... Spacing of the energy grid (default: None, smearing/16)
+
+        OUTPUT PARAMETERS:
+        -----------------
+
+        energies ........................ The energy grid
+        oxidation_values ................ Oxidation lineshape on the grid
+        reduction_values ................ Reduction lineshape on the grid
+        oxidation ....................... Interpolating functions (zero outside the grid)
+        reduction .......................
+    """
+    def __init__(self, **kwargs):
+        self.init_input_variables(
+                                  omega_occupied      = None,
+                                  omega_unoccupied    = None,
+                                  mass                = None,
+                                  equilibrium_shift   = None,
+                                  thermodynamic_level = 0.,
+                                  temperature         = None,
+                                  smearing            = None,
+                                  energy_range        = None,
+                                  energy_step         = None
+                                  )
+        self.init_output_variables(
+                                  energies         = None,
+                                  oxidation_values = None,
+                                  reduction_values = None,
+                                  oxidation        = None,
+                                  reduction        = None
+                                  )
+        self.set_variables(kwargs)
+
+    def do_update(self):
+        from tools import LinearInterpolant
+        if self.changed:
+            energies,oxidation,reduction = self.__lineshapes([self.temperature])
+            self.internal_energies         = energies
+            self.internal_oxidation_values = oxidation[0]
+            self.internal_reduction_values = reduction[0]
+            self.internal_oxidation = LinearInterpolant(energies,self.oxidation_values)
+            self.internal_reduction = LinearInterpolant(energies,self.reduction_values)
+            return True
+        return False
+
+    def oxidation_sweep(self,E,temperatures):
+        """ Oxidation lineshape for an array of temperatures, shape (len(temperatures),)+E.shape """
+        from numpy import array,interp
+        energies,oxidation,_ = self.__lineshapes(temperatures)
+        return array([ interp(E,energies,values,left=0.,right=0.) for values in oxidation ])
+
+    def reduction_sweep(self,E,temperatures):
+        """ Reduction lineshape for an array of temperatures, shape (len(temperatures),)+E.shape """
+        from numpy import array,interp
+        energies,_,reduction = self.__lineshapes(temperatures)
+        return array([ interp(E,energies,values,left=0.,right=0.) for values in reduction ])
+
+    def __grid(self,temperatures):
+        from scipy.constants import hbar
+        from scipy.constants import k as kB
+        from numpy import ceil
+        sigma = self.smearing
+        dE = self.energy_step
+        if dE == None:
+            dE = sigma/16.
+        if self.energy_range == None:
+            m = self.mass ; d = self.equilibrium_shift
+            relaxation = .5*m*d**2*max(self.omega_occupied,self.omega_unoccupied)**2
+            phonon     = hbar*max(self.omega_occupied,self.omega_unoccupied)
+            width = 4*relaxation + 10*(relaxation*kB*max(temperatures))**.5 + 20*phonon + 10*sigma
+            E_min = self.thermodynamic_level - width
+            E_max = self.thermodynamic_level + width
+        else:
+            E_min,E_max = self.energy_range
+        n = 1
+        while n < ceil((E_max-E_min)/dE)+1:
+            n *= 2
+        return E_min,dE,n
+
+    def __lineshapes(self,temperatures):
+        from scipy.constants import hbar,pi
+        from scipy.constants import k as kB
+        from numpy import arange,exp,log1p,zeros
+        from numpy.fft import fft,ifftshift
+        E_min,dE,n = self.__grid(temperatures)
+        dt = 2*pi*hbar/(n*dE)
+        t  = (arange(n)-n/2)*dt
+
+        omega_o = self.omega_occupied ; omega_u = self.omega_unoccupied
+        alpha_o = self.mass*omega_o/hbar ; alpha_u = self.mass*omega_u/hbar
+        d = self.equilibrium_shift
+        # Common factors: thermodynamic level, smearing, and the shift of the grid to E_min
+        common = 1j*(self.thermodynamic_level-E_min)*t/hbar - (self.smearing*t/hbar)**2/2
+
+        oxidation = zeros((len(temperatures),n))
+        reduction = zeros((len(temperatures),n))
+        for k,T in enumerate(temperatures):
+            beta = 1./(kB*T)
+            log_Z_o = -beta*hbar*omega_o/2 - log1p(-exp(-beta*hbar*omega_o))
+            log_Z_u = -beta*hbar*omega_u/2 - log1p(-exp(-beta*hbar*omega_u))
+            # sum_ij p_i S_ij^2 exp(i(E_T+E_i-E_j)t/hbar) and the same with p_j
+            G_oxidation = exp(harmonic_trace(alpha_o,omega_o,hbar*beta-1j*t,alpha_u,omega_u,1j*t,d) - log_Z_o + common)
+            G_reduction = exp(harmonic_trace(alpha_o,omega_o,-1j*t,alpha_u,omega_u,hbar*beta+1j*t,d) - log_Z_u + common)
+            oxidation[k] = (fft(ifftshift(G_oxidation)).real*dt/(2*pi*hbar)).clip(0.)
+            reduction[k] = (fft(ifftshift(G_reduction)).real*dt/(2*pi*hbar)).clip(0.)
+        return E_min+arange(n)*dE,oxidation,reduction
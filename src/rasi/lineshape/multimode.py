@@ -0,0 +1,128 @@
+"""
+    Reliability Analysis of Semiconductor Interfaces -- Multi-mode lineshapes
+    -------------------------------------------------------------------------
+
+    If a defect couples to several independent vibrational modes, its
+    lineshape is the convolution of the lineshapes of the single modes.
+
+"""
+###############################################################################
+#
+#  RASI ... Reliability Analysis of Semiconductor Interfaces
+#
+#  (c) 2013-2014 Franz Schanovsky
+#
+#  This project is dedicated to the loving memory of Margarete and Johann
+#  Mittermayr.
+#
+###############################################################################
+#
+#    This software is licensed under the EUPL V 1.1
+#
+#    This software is provided "as is" without warranty of any kind, see the
+#    respective section in the EUPL. USE AT YOUR OWN RISK.
+#
+###############################################################################
+
+from rasi.base import BasicCalculator
+
+class MultiModeLineShape(BasicCalculator):
+    """
+        MultiModeLineShape combines the discrete lineshapes of several independent
+        modes into the lineshape of the multi-mode system. The lines of every mode
+        are binned onto a grid with the spacing energy_step (linearly distributed
+        to the two nearest grid points, which conserves weight and mean energy)
+        and the binned spectra are convolved by FFT. The cost grows with the size
+        of the grid, not with the number of line combinations.
+
+        The outputs are the same as those of DiscreteLineShape, so the result can
+        be smeared with a SmearedLineShape.
+
+        INPUT PARAMETERS:
+        modes ............... List of DiscreteLineShapes, one per mode. Their own
+                              thermodynamic levels are subtracted from their line
+                              energies.
+        thermodynamic_level . Thermodynamic level of the multi-mode system
+        energy_step ......... Spacing of the energy grid
+
+        OUTPUT PARAMETERS:
+        oxidation_energies .. Energies of the grid points
+        oxidation_weights ... Oxidation weights on the grid points
+        reduction_energies .. Energies of the grid points
+        reduction_weights ... Reduction weights on the grid points
+    """
+    def __init__(self, **kwargs):
+        self.init_input_variables(
+                                  modes               = [],
+                                  thermodynamic_level = 0.,
+                                  energy_step         = None
+                                 )
+        self.init_output_variables(
+                                   oxidation_energies = None,
+                                   oxidation_weights  = None,
+                                   reduction_energies = None,
+                                   reduction_weights  = None
+                                  )
+        self.set_variables(kwargs)
+
+    def dependencies(self):
+        return BasicCalculator.dependencies(self) + list(self.modes)
+
+    def do_update(self):
+        from numpy import newaxis
+        modes_changed = [ mode.update() for mode in self.modes ]
+        if self.changed or True in modes_changed:
+            spectra = [ (mode.oxidation_energies,mode.oxidation_weights[newaxis,:],mode.reduction_weights[newaxis,:])
+                        for mode in self.modes ]
+            energies,oxidation,reduction = self.__combine(spectra)
+            self.internal_oxidation_energies = energies
+            self.internal_oxidation_weights  = oxidation[0]
+            self.internal_reduction_energies = energies
+            self.internal_reduction_weights  = reduction[0]
+            return True
+        return False
+
+    def temperature_sweep(self,temperatures):
+        """
+            Combines the temperature sweeps of the modes (see
+            DiscreteLineShape.temperature_sweep). Returns (energies,oxidation_weights,
+            reduction_weights) with weights of shape (len(temperatures),len(energies)).
+        """
+        self.update()
+        return self.__combine([ mode.temperature_sweep(temperatures) for mode in self.modes ])
+
+    def __combine(self,spectra):
+        from numpy import floor,arange,concatenate,maximum
+        from numpy.fft import rfft,irfft
+        from scipy.sparse import csr_matrix
+        dE = self.energy_step
+
+        start = 0.
+        binned = []
+        for mode,(energies,oxidation,reduction) in zip(self.modes,spectra):
+            energies = energies - mode.thermodynamic_level
+            E_min = energies.min()
+            u = (energies-E_min)/dE
+            i = floor(u).astype(int)
+            f = u-i
+            n_bins = i.max()+2
+            lines = arange(len(energies))
+            binning = csr_matrix((concatenate((1.-f,f)),(concatenate((i,i+1)),concatenate((lines,lines)))),
+                                 shape=(n_bins,len(energies)))
+            binned.append((binning.dot(oxidation.T).T,binning.dot(reduction.T).T))
+            start += E_min
+
+        # Zero padding to the full length of the convolution avoids wrap-around
+        n = sum(oxidation.shape[1] for oxidation,_ in binned)-len(binned)+1
+        n_fft = 1
+        while n_fft < n:
+            n_fft *= 2
+        result = []
+        for k in (0,1):
+            spectrum = 1.
+            for weights in binned:
+                spectrum = spectrum*rfft(weights[k],n_fft,axis=1)
+            # Remove the FFT round-off, weights are non-negative
+            result.append(maximum(irfft(spectrum,n_fft,axis=1)[:,:n],0.))
+        energies = self.thermodynamic_level + start + arange(n)*dE
+        return energies,result[0],result[1]
@@ -17,7 +17,7 @@
 ###############################################################################
 
 
-from constants import hred
+from scipy.constants import hbar as hred
 from math import sqrt,log,pi,exp
 from scipy.special import gammaln
 from tools import write_data
@@ -26,7 +26,8 @@ from tools import write_data
 #################################################################################
 #
 # Computes the values of hermite functions up to order n at point x using the
-# recurrence relation
+# recurrence relation. x may also be an array, then every entry of the result
+# is an array of the same shape.
 #
 #################################################################################
 
@@ -34,6 +35,7 @@ def hermite_function_rec(
                     n, # Quantum number
                     x  # normalized x value 
                     ):
+    from numpy import exp
     psi = [ 1./sqrt(sqrt(pi))*exp(-x**2/2) ,  2./sqrt(2*sqrt(pi))*exp(-x**2/2)*x ]
     for i in range(2,n+1):
         psi += [ sqrt(2./i)*x*psi[-1] - sqrt(float(i-1)/i)*psi[-2] ]
@@ -41,6 +43,23 @@ def hermite_function_rec(
     return psi
  
 
+#################################################################################
+#
+# Squared deviation of the overlap matrix S from the Ansbacher recurrence 
+#
+#################################################################################
+
+def ansbacher_error(S,beta,gamma):
+    from numpy import arange,sqrt
+    i = arange(2,S.shape[0],dtype=float)[:,None]
+    j = arange(1,S.shape[1],dtype=float)[None,:]
+    Sans = beta**2*gamma/(1+beta**2)*sqrt(2./i)*S[1:-1,1:] \
+           + 2*beta/(1+beta**2)*sqrt(j/i)*S[1:-1,:-1] \
+           + (1-beta**2)/(1+beta**2)*sqrt((i-1)/i)*S[:-2,1:]
+    return ((S[2:,1:] - Sans)**2).sum()
+
+
+
 def trapezoidal_eval(
                     # Physical parameters
                     omega_i,     # Parabolic const. of initial state
@@ -59,7 +78,9 @@ def trapezoidal_eval(
                     echo=True,   # Report status to stdout
                     hermite=hermite_function_rec,
                                  # Method to calculate hermite functions
-                    nx_wf = 1000  # Number of samples for wavefuncion files
+                    nx_wf = 1000, # Number of samples for wavefuncion files
+                    block_size = 4096
+                                 # Number of abscissae evaluated at once
                     ):
    
     if n_eigs_f == None:
@@ -76,9 +97,11 @@ def trapezoidal_eval(
     a_init = sqrt(m*omega_i/hred)
     a_finl = sqrt(m*omega_f/hred)
     
-    # The subsequently used wave functions
-    wavefuncs_init = lambda x: [ sqrt(a_init)*h for h in hermite(n_eigs_i-1,a_init*x)]
-    wavefuncs_finl = lambda x: [ sqrt(a_finl)*h for h in hermite(n_eigs_f-1,a_finl*(x - abs(x_s)))]
+    from numpy import array,arange,dot,zeros
+
+    # The subsequently used wave functions, as tables (states x abscissae)
+    wavefuncs_init = lambda x: sqrt(a_init)*array(hermite(n_eigs_i-1,a_init*x))[:n_eigs_i]
+    wavefuncs_finl = lambda x: sqrt(a_finl)*array(hermite(n_eigs_f-1,a_finl*(x - abs(x_s))))[:n_eigs_f]
 
     # The actual integration boundaries
     x_lower = - x_range/a_init
@@ -89,21 +112,15 @@ def trapezoidal_eval(
         if echo:
             print;print "Writing wave functions...";print
         dx = (x_upper-x_lower)/nx_wf
-        xx = x_lower
-        xvals = [x_lower] 
-        w_i = [ [ vv ] for vv in wavefuncs_init(xx) ]
-        w_f = [ [ vv ] for vv in wavefuncs_finl(xx) ]
-        for i in range(nx_wf):
-            xx += dx
-            w_i = [ ll + [vv] for ll,vv in zip(w_i,wavefuncs_init(xx)) ]
-            w_f = [ ll + [vv] for ll,vv in zip(w_f,wavefuncs_finl(xx)) ]
-            xvals += [ xx ]
-        write_data(prefix+"_wf_i.dat",xvals,[xx*a_init for xx in xvals],*tuple(w_i))
-        write_data(prefix+"_wf_f.dat",xvals,[(xx+abs(x_s))*a_finl for xx in xvals],*tuple(w_f))
+        xvals = x_lower + arange(nx_wf+1)*dx
+        w_i = wavefuncs_init(xvals)
+        w_f = wavefuncs_finl(xvals)
+        write_data(prefix+"_wf_i.dat",xvals,xvals*a_init,*tuple(w_i))
+        write_data(prefix+"_wf_f.dat",xvals,(xvals+abs(x_s))*a_finl,*tuple(w_f))
 
 
     if echo:
-        from units import Ang
+        from scipy.constants import angstrom as Ang
         print "Prefactors: "
         print "----------"
         print "    a_init = %e ; a_finl = %e"%(a_init,a_finl)
@@ -113,23 +130,19 @@ def trapezoidal_eval(
         print "    left = %e Angstroms; right = %e Angstroms"%(x_lower/Ang,x_upper/Ang)
         print;print
 
-    # The function that will actually be integrated (returns a matrix of all the
-    # possible wavefunction multiplications)
-    _f = lambda wfi,wff: [ [ wf_i * wf_j for wf_j in wff ] for wf_i in wfi ]
-    f = lambda x: _f(wavefuncs_init(x),wavefuncs_finl(x))
-
-    # Some helper functions for overlap matrix handling
-    add = lambda a,b: [ [ x + y for x,y in zip(vx,vy) ] for vx,vy in zip(a,b) ]
-    mult = lambda a,mx: [ [ a*x  for x in vx ] for vx in mx ]
-    diff = lambda mx,my: [ [ x - y for x,y in zip(vx,vy) ] for vx,vy in zip(mx,my) ]
-    norm = lambda mx: sum(sum(x**2 for x in vx) for vx in mx)
-    mmax = lambda mx: max(max(vx) for vx in mx)
-    mmin = lambda mx: min(min(vx) for vx in mx)
+    # Sum of all possible wavefunction multiplications over the abscissae xs, 
+    # in blocks of block_size abscissae to bound the memory footprint
+    def f_sum(xs):
+        result = zeros((n_eigs_i,n_eigs_f))
+        for start in range(0,len(xs),block_size):
+            block = xs[start:start+block_size]
+            result += dot(wavefuncs_init(block),wavefuncs_finl(block).T)
+        return result
    
     # Initial computation
-    S = mult(.5*(x_upper-x_lower),add(f(x_upper),f(x_lower)))
+    S = .5*(x_upper-x_lower)*f_sum(array([x_upper,x_lower]))
 
-    normS=norm(S)
+    normS=(S**2).sum()
     print "Initial computation norm (should be as low as possible):"
     print "-------------------------------------------------------"
     print "                   norm(S) = %e"%normS
@@ -149,22 +162,13 @@ def trapezoidal_eval(
         nsteps = 1 << (iref-1)
         dx = (x_upper-x_lower)/nsteps
         xx = x_lower + .5*dx
-        Simprove = f(xx)
-        for i in range(1,nsteps): Simprove = add(Simprove,f(xx+i*dx))
-        S_new = mult(.5,add(S,mult(dx,Simprove)))
-        nrm = norm(diff(S_new,S))
+        S_new = .5*(S + dx*f_sum(xx+arange(nsteps)*dx))
+        nrm = ((S_new-S)**2).sum()
         S = S_new
-        err = 0.
-        lrgst = 0.
-        lrgidx = ()
-        for i in range(2,len(S)):
-            for j in range(1,len(S[0])):
-                Sans = beta**2*gamma/(1+beta**2)*sqrt(2./i)*S[i-1][j]+2*beta/(1+beta**2)*sqrt(float(j)/i)*S[i-1][j-1]+(1-beta**2)/(1+beta**2)*sqrt(float(i-1)/i)*S[i-2][j]
-                ierr = (S[i][j] - Sans)**2
-                err += ierr
+        err = ansbacher_error(S,beta,gamma)
 
         if echo:
-            print "%10d %20e %20f %20e"%(iref,nrm,mmax(S),err)
+            print "%10d %20e %20f %20e"%(iref,nrm,S.max(),err)
         
         if iref > minref:
             if iref > maxref:
@@ -180,8 +184,7 @@ def trapezoidal_eval(
     return (Ew_i,Ew_f,S)
 
 if __name__ == "__main__":
-    from tools import write_data
-    from units import *
+    from scipy.constants import atomic_mass as amu, angstrom as Ang, eV
     #print "Testing mode!!!"
     mass = 24.6619642123*amu
     #x_s = 0.
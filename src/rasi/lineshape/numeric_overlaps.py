@@ -0,0 +1,142 @@
+"""
+    Reliability Analysis of Semiconductor Interfaces -- Numeric overlaps for arbitrary potentials
+    ---------------------------------------------------------------------------------------------
+
+    For anharmonic potential energy curves, e.g. from DFT scans along the
+    reaction coordinate, the vibrational states and their overlaps are
+    calculated by solving the 1D Schroedinger equation numerically.
+
+"""
+###############################################################################
+#
+#  RASI ... Reliability Analysis of Semiconductor Interfaces
+#
+#  (c) 2013-2014 Franz Schanovsky
+#
+#  This project is dedicated to the loving memory of Margarete and Johann
+#  Mittermayr.
+#
+###############################################################################
+#
+#    This software is licensed under the EUPL V 1.1
+#
+#    This software is provided "as is" without warranty of any kind, see the
+#    respective section in the EUPL. USE AT YOUR OWN RISK.
+#
+###############################################################################
+
+from rasi.base import BasicCalculator
+
+def bound_states(dx,V,mass,n_states=None):
+    """
+        Solves the 1D Schroedinger equation for the potential V, sampled with the
+        spacing dx (see full_numeric.schroedinger_solve). Only bound states, i.e. 
+        states below max(V), are returned, at most n_states of them.
+
+        Returns the eigenvalues and the eigenvectors (normalized to a sum of
+        squares of one) as the rows of an array.
+    """
+    from numpy        import asarray
+    from full_numeric import schroedinger_solve
+    V = asarray(V,dtype=float)
+    E,psi = schroedinger_solve(dx,V,mass,E_max=V.max(),n_states=n_states)
+    bound = E < V.max()
+    return E[bound],psi[bound]
+
+
+class NumericOverlaps(BasicCalculator):
+    """
+        NumericOverlaps calculates the vibrational states of arbitrary potential
+        energy curves and their overlaps. It can be used as overlap provider of a
+        DiscreteLineShape instead of SchmidtOverlaps.
+
+        INPUT PARAMETERS:
+        ----------------
+
+        mass ............................ Modal mass
+        coordinates ..................... Configuration coordinates the potentials are sampled at
+        potential_occupied .............. Potential energy curve of the occupied state
+        potential_unoccupied ............ Potential energy curve of the unoccupied state
+        n_grid .......................... If None, the coordinates have to be equidistant and are
+                                          used as the grid for the Schroedinger equation. Otherwise
+                                          the potentials are interpolated by cubic splines onto
+                                          n_grid equidistant points (default: None)
+        n_states_occupied ............... Maximum number of vibrational states to consider in the
+                                          occupied state (default: None, all bound states)
+        n_states_unoccupied ............. Same for the unoccupied state
+
+        OUTPUT PARAMETERS:
+        -----------------
+
+        energies_occupied ............... Array of vibrational energies in the occupied state, relative
+                                          to the minimum of the potential.
+        energies_unoccupied ............. Array of vibrational energies in the unoccupied state, relative
+                                          to the minimum of the potential.
+        overlap_matrix .................. The overlap matrix between the occupied and unoccupied states
+                                          (first index corresponds to occupied, second to unoccupied).
+        grid ............................ The grid of the Schroedinger equation
+        wavefunctions_occupied .......... The vibrational wavefunctions on the grid as rows of an array,
+                                          normalized to a sum of squares of one
+        wavefunctions_unoccupied ........
+
+        The eigenpairs of both states are kept, so if only one of the potentials
+        changes, only this one is solved again.
+    """
+
+    def __init__(self, **kwargs):
+        self.init_input_variables(
+                                  mass                 = None,
+                                  coordinates          = None,
+                                  potential_occupied   = None,
+                                  potential_unoccupied = None,
+                                  n_grid               = None,
+                                  n_states_occupied    = None,
+                                  n_states_unoccupied  = None
+                                  )
+        self.init_output_variables(
+                                  energies_occupied        = None,
+                                  energies_unoccupied      = None,
+                                  overlap_matrix           = None,
+                                  grid                     = None,
+                                  wavefunctions_occupied   = None,
+                                  wavefunctions_unoccupied = None
+                                  )
+        self.set_variables(kwargs)
+
+    def __grid(self):
+        from numpy import asarray,diff,linspace
+        x = asarray(self.coordinates,dtype=float)
+        if self.n_grid == None:
+            dx = diff(x)
+            if abs(dx-dx.mean()).max() > 1e-6*abs(dx.mean()):
+                raise ValueError("Non-equidistant coordinates require n_grid.")
+            return x,dx.mean()
+        grid = linspace(x[0],x[-1],self.n_grid)
+        return grid,grid[1]-grid[0]
+
+    def __potential(self,potential):
+        from numpy import asarray
+        from scipy.interpolate import CubicSpline
+        V = asarray(potential,dtype=float)
+        if self.n_grid == None:
+            return V
+        return CubicSpline(self.coordinates,V)(self.grid)
+
+    def do_update(self):
+        from numpy import dot
+        if self.changed:
+            changed = self.changed_variables()
+            common  = bool(changed.intersection(["mass","coordinates","n_grid"]))
+            if common or self.grid is None:
+                self.internal_grid,self.__dict__["_dx"] = self.__grid()
+
+            for state in ("occupied","unoccupied"):
+                if common or changed.intersection(["potential_"+state,"n_states_"+state]):
+                    V = self.__potential(getattr(self,"potential_"+state))
+                    E,psi = bound_states(self._dx,V,self.mass,getattr(self,"n_states_"+state))
+                    setattr(self,"internal_energies_"+state,E-V.min())
+                    setattr(self,"internal_wavefunctions_"+state,psi)
+
+            self.internal_overlap_matrix = dot(self.wavefunctions_occupied,self.wavefunctions_unoccupied.transpose())
+            return True
+        return False
@@ -28,13 +28,124 @@ def gaussian(sigma,x0,x):
     from scipy import exp
     return ((2.*pi*sigma**2)**-.5)*exp(-(x-x0)**2/(2*sigma**2)) 
 
+def truncated_gaussian_sum(sigma,x0,weights,x,tolerance,max_pairs=1<<20):
+    """
+        Evaluates sum(weights*gaussian(sigma,x0,x)) at the (arbitrary) points x, 
+        taking into account only the lines within c*sigma of each point, where 
+        exp(-c**2/2) = tolerance. The absolute error is thus below 
+        tolerance*sum(abs(weights))*gaussian(sigma,0,0). The line positions x0
+        have to be sorted. The work is split into blocks of at most max_pairs 
+        (point,line) combinations.
+    """
+    from math  import log,sqrt,pi
+    from numpy import asarray,searchsorted,cumsum,repeat,arange,bincount,zeros,exp
+    x     = asarray(x,dtype=float)
+    x_all = x.ravel()
+    cutoff = sqrt(-2*log(tolerance))*sigma
+    lower = searchsorted(x0,x_all-cutoff,"left")
+    upper = searchsorted(x0,x_all+cutoff,"right")
+    counts = upper-lower
+    ends   = cumsum(counts)
+
+    values = zeros(len(x_all))
+    i_start = 0
+    while i_start < len(x_all):
+        # Largest block of points that does not exceed max_pairs (but at least one point)
+        offset = ends[i_start-1] if i_start > 0 else 0
+        i_end  = max(i_start+1,searchsorted(ends,offset+max_pairs,"right"))
+        n = counts[i_start:i_end]
+        first = ends[i_start:i_end]-n-offset
+        point = repeat(arange(i_end-i_start),n)
+        line  = arange(n.sum())-repeat(first,n)+repeat(lower[i_start:i_end],n)
+        values[i_start:i_end] = bincount(point,weights=weights[line]*exp(-(x_all[i_start+point]-x0[line])**2/(2*sigma**2)),
+                                         minlength=i_end-i_start)
+        i_start = i_end
+    values *= (2.*pi*sigma**2)**-.5
+    if x.ndim == 0:
+        return values[0]
+    return values.reshape(x.shape)
+
+def fft_gaussian_sum(sigma,x0,weights,x_start,dx,n,tolerance):
+    """
+        Evaluates sum(weights*gaussian(sigma,x0,x)) on the uniform grid 
+        x = x_start + dx*arange(n).
+
+        The lines are deposited onto a fine grid with a spacing h <= sigma/2. The
+        offset d of each line from its nearest grid node is accounted for by a 
+        Taylor expansion of the Gaussian (as in the fast Gauss transform):
+
+            exp(-(u-d)**2/(2*sigma**2)) = exp(-d**2/(2*sigma**2)) * exp(-u**2/(2*sigma**2)) 
+                                          * sum_p (u/sigma)**p*(d/sigma)**p/p!
+
+        so every order p is a discrete convolution of the deposited moments with 
+        the kernel (u/sigma)**p*gaussian(sigma,0,u), which is carried out by FFT. The
+        number of orders is chosen such that the truncated series and the truncated 
+        kernel (see truncated_gaussian_sum) both stay below the error bound 
+        tolerance*sum(abs(weights))*gaussian(sigma,0,0).
+    """
+    from math      import log,sqrt,pi,ceil,factorial,e
+    from numpy     import rint,arange,bincount,zeros,exp
+    from numpy.fft import rfft,irfft
+
+    ratio  = int(ceil(2*dx/sigma))
+    h      = dx/ratio
+    n_kern = int(ceil(sqrt(-2*log(tolerance))*sigma/h))
+    n_fine = (n-1)*ratio+1+2*n_kern
+
+    # Nearest fine grid node of every line, the fine grid starts n_kern nodes before x_start
+    node   = rint((x0-x_start)/h).astype(int)+n_kern
+    inside = (node >= 0) & (node < n_fine)
+    node   = node[inside]
+    d      = (x0[inside]-x_start-(node-n_kern)*h)/sigma
+    w      = weights[inside]*exp(-d**2/2)
+
+    u      = arange(-n_kern,n_kern+1)*h/sigma
+    kernel = exp(-u**2/2)*(2.*pi*sigma**2)**-.5
+
+    size = 1
+    while size < n_fine+2*n_kern:
+        size *= 2
+
+    rho = h/(2*sigma)
+    spectrum = zeros(size//2+1,dtype=complex)
+    p = 0
+    while True:
+        moments   = bincount(node,weights=w*d**p/factorial(p),minlength=n_fine)
+        spectrum += rfft(moments,size)*rfft(u**p*kernel,size)
+        p += 1
+        # max_u |u|**p*exp(-u**2/2) = (p/e)**(p/2) bounds the next order
+        if (p/e)**(p/2.)*rho**p/factorial(p) < tolerance:
+            break
+    values = irfft(spectrum,size)
+    return values[2*n_kern:2*n_kern+(n-1)*ratio+1:ratio]
+
 from rasi.base import BasicCalculator
 
 class SmearedLineShape(BasicCalculator):
+    """
+        SmearedLineShape replaces each line of a discrete lineshape by a Gaussian.
+
+        INPUT PARAMETERS:
+        ----------------
+
+        discrete_lineshape .. Discrete lineshape (e.g. DiscreteLineShape)
+        smearing ............ Standard deviation of the Gaussians
+        tolerance ........... If not None, the lineshapes are evaluated approximately with
+                              an absolute error below tolerance*(total weight)*(peak of the 
+                              Gaussian). Uniform energy grids are then evaluated by FFT, all
+                              other energies with a truncated Gaussian (default: None)
+
+        OUTPUT PARAMETERS:
+        -----------------
+
+        oxidation(E) ........ Oxidation lineshape
+        reduction(E) ........ Reduction lineshape
+    """
     def __init__(self,**kwargs):
         self.init_input_variables(
                                    discrete_lineshape = None,
                                    smearing           = None,
+                                   tolerance          = None
                                  )
         self.init_output_variables()
         self.set_variables(kwargs)
@@ -45,11 +156,37 @@ class SmearedLineShape(BasicCalculator):
         return self.changed or ls_changed
 
     def __smeared(self,energies,weights,E):
+        from numpy import asarray,diff
         sigma = self.smearing
-        value = 0.
-        for E0,weight in zip(energies,weights):
-            value += weight*gaussian(sigma,E0,E)
-        return value
+        if self.tolerance == None:
+            value = 0.
+            for E0,weight in zip(energies,weights):
+                value += weight*gaussian(sigma,E0,E)
+            return value
+
+        E = asarray(E,dtype=float)
+        if E.ndim == 1 and len(E) > 2:
+            dE = (E[-1]-E[0])/(len(E)-1)
+            if dE > 0 and abs(diff(E)-dE).max() <= 1e-9*dE:
+                return fft_gaussian_sum(sigma,energies,weights,E[0],dE,len(E),self.tolerance)
+        if (diff(energies) < 0).any():
+            order = energies.argsort(kind="mergesort")
+            energies = energies[order] ; weights = weights[order]
+        return truncated_gaussian_sum(sigma,energies,weights,E,self.tolerance)
+
+    def __smeared_sweep(self,energies,weights,E,max_block=1<<22):
+        from numpy import asarray,newaxis,zeros
+        if self.tolerance != None:
+            return asarray([ self.__smeared(energies,w,E) for w in weights ])
+        # Exact evaluation as a matrix product with blocks of the Gaussian matrix
+        E = asarray(E,dtype=float)
+        E_all = E.ravel()
+        values = zeros((len(weights),len(E_all)))
+        block = max(1,max_block//max(1,len(E_all)))
+        for start in xrange(0,len(energies),block):
+            G = gaussian(self.smearing,energies[start:start+block,newaxis],E_all[newaxis,:])
+            values += weights[:,start:start+block].dot(G)
+        return values.reshape((len(weights),)+E.shape)
 
     def oxidation(self,E):
         energies = self.discrete_lineshape.oxidation_energies
@@ -61,12 +198,49 @@ class SmearedLineShape(BasicCalculator):
         weights  = self.discrete_lineshape.reduction_weights
         return self.__smeared(energies,weights,E)
 
+    def oxidation_sweep(self,E,temperatures):
+        """ 
+            Oxidation lineshape for an array of temperatures, shape (len(temperatures),)+E.shape.
+            With truncated overlaps, the temperatures are limited to the truncation temperature
+            (see DiscreteLineShape.temperature_sweep).
+        """
+        energies,weights,_ = self.discrete_lineshape.temperature_sweep(temperatures)
+        return self.__smeared_sweep(energies,weights,E)
+
+    def reduction_sweep(self,E,temperatures):
+        """ Reduction lineshape for an array of temperatures, shape (len(temperatures),)+E.shape, see oxidation_sweep """
+        energies,_,weights = self.discrete_lineshape.temperature_sweep(temperatures)
+        return self.__smeared_sweep(energies,weights,E)
+
 class DiscreteLineShape(BasicCalculator):
+    """
+        DiscreteLineShape turns the vibrational energies and overlaps of an 
+        overlap provider (e.g. SchmidtOverlaps) into a set of thermally weighted 
+        lines.
+
+        INPUT PARAMETERS:
+        ----------------
+
+        overlaps ............ Overlap provider (energies_occupied, energies_unoccupied, overlap_matrix)
+        temperature ......... Temperature in Kelvins
+        thermodynamic_level . Energetic shift between the two electronic states
+        energy_resolution ... If not None, the lines are binned onto a grid with this spacing
+                              and the weights within a bin are summed up (default: None)
+
+        OUTPUT PARAMETERS:
+        -----------------
+
+        oxidation_energies .. Sorted line energies for oxidation
+        oxidation_weights ... Line weights for oxidation
+        reduction_energies .. Sorted line energies for reduction
+        reduction_weights ... Line weights for reduction
+    """
     def __init__(self, **kwargs):
         self.init_input_variables(
                                    overlaps            = None,
                                    temperature         = None,
-                                   thermodynamic_level = None
+                                   thermodynamic_level = None,
+                                   energy_resolution   = None
                                  )
         self.init_output_variables(
                                    oxidation_energies = None,
@@ -77,49 +251,123 @@ class DiscreteLineShape(BasicCalculator):
         self.set_variables(kwargs)
 
     def do_update(self):
-        from scipy.constants import k as kB
-        from scipy import exp,array
         overlaps_changed = self.overlaps.update()
 
         if self.changed or overlaps_changed:
-            overlaps = self.overlaps
-            T        = self.temperature
-            S        = overlaps.overlap_matrix
-            ET       = self.thermodynamic_level
-
-            E_occupied   = overlaps.energies_occupied
-            E_unoccupied = overlaps.energies_unoccupied
-
-            p_occupied   = exp(-E_occupied/(kB*T))
-            p_unoccupied = exp(-E_unoccupied/(kB*T))
-
-            if hasattr(overlaps,"partition_function_occupied"):
-                Z_occupied = overlaps.partition_function_occupied(T)
-            else:
-                Z_occupied = p_occupied.sum()
-
-            if hasattr(overlaps,"partition_function_unoccupied"):
-                Z_unoccupied = overlaps.partition_function_unoccupied(T)
-            else:
-                Z_unoccupied = p_unoccupied.sum()
-
-            p_occupied   /= Z_occupied
-            p_unoccupied /= Z_unoccupied
-
-            oxidation = []
-            reduction = []
-            for i in xrange(len(p_occupied)):
-                for j in xrange(len(p_unoccupied)):
-                    oxidation.append((ET+E_occupied[i]-E_unoccupied[j] , p_occupied[i]   * S[i,j]**2))
-                    reduction.append((ET+E_occupied[i]-E_unoccupied[j] , p_unoccupied[j] * S[i,j]**2))
-            oxidation.sort(key=(lambda (E,w): E))
-            reduction.sort(key=(lambda (E,w): E))
-
-            self.internal_oxidation_weights  = array([ w for E,w in oxidation ])
-            self.internal_oxidation_energies = array([ E for E,w in oxidation ])
-
-            self.internal_reduction_weights  = array([ w for E,w in reduction ])
-            self.internal_reduction_energies = array([ E for E,w in reduction ])
+            # The line energies and overlaps do not depend on the temperature
+            lines_changed = bool(self.changed_variables().difference(["temperature"]))
+            if overlaps_changed or lines_changed or self.__dict__.get("_line_table") == None:
+                self.__dict__["_line_table"] = self.__lines()
+
+            self.__check_truncation([self.temperature])
+            energies,oxidation,reduction = self.__weights([self.temperature])
+            self.internal_oxidation_weights  = oxidation[0]
+            self.internal_oxidation_energies = energies
+
+            self.internal_reduction_weights  = reduction[0]
+            self.internal_reduction_energies = energies
             return True
         return False
 
+    def temperature_sweep(self,temperatures):
+        """
+            Calculates the line weights for a whole array of temperatures at once,
+            reusing the temperature independent line energies and overlaps. The
+            calculator is updated first, so all inputs have to be set.
+
+            All temperatures share one overlap table. If the overlaps are truncated
+            (see SchmidtOverlaps.occupation_cutoff), max(temperatures) must not exceed 
+            the temperature of the overlaps, otherwise a ValueError is raised.
+
+            Returns (energies,oxidation_weights,reduction_weights), where the weights
+            are arrays of shape (len(temperatures),len(energies)).
+        """
+        self.update()
+        self.__check_truncation(temperatures)
+        return self.__weights(temperatures)
+
+    def __check_truncation(self,temperatures):
+        """
+            Truncated overlap providers (see SchmidtOverlaps) only contain the initial
+            states that are occupied up to their own temperature. At higher temperatures
+            the missing states would silently lose weight.
+        """
+        overlaps = self.overlaps
+        if getattr(overlaps,"occupation_cutoff",None) == None:
+            return
+        if max(temperatures) > overlaps.temperature:
+            raise ValueError("The overlaps are truncated at %g K, they cannot be used at %g K."
+                             %(overlaps.temperature,max(temperatures)))
+
+    def __lines(self):
+        """
+            Sorted line energies, together with the vibrational state indices and
+            squared overlaps of each line. If lines are binned, the last entry
+            is a sparse matrix that sums the lines into the bins.
+        """
+        from scipy import subtract,indices,rint,ones,unique
+        from scipy.sparse import issparse,csr_matrix
+        overlaps = self.overlaps
+        S        = overlaps.overlap_matrix
+        ET       = self.thermodynamic_level
+
+        E_occupied   = overlaps.energies_occupied
+        E_unoccupied = overlaps.energies_unoccupied
+
+        # Truncated overlap providers deliver sparse matrices, only the stored entries are lines
+        if issparse(S):
+            S = S.tocoo()
+            i,j = S.row,S.col
+            energies = ET+E_occupied[i]-E_unoccupied[j]
+            S2       = S.data**2
+        else:
+            i,j = [ index.ravel() for index in indices(S.shape) ]
+            energies = subtract.outer(ET+E_occupied,E_unoccupied).ravel()
+            S2       = (S**2).ravel()
+
+        order = energies.argsort(kind="mergesort")
+        energies = energies[order] ; i = i[order] ; j = j[order] ; S2 = S2[order]
+
+        binning = None
+        if self.energy_resolution != None:
+            # Bins are centered at multiples of energy_resolution, only occupied bins are kept
+            dE = self.energy_resolution
+            k = rint(energies/dE).astype(int)
+            k,line_bin = unique(k,return_inverse=True)
+            energies = k*dE
+            binning = csr_matrix((ones(len(line_bin)),(line_bin,range(len(line_bin)))),shape=(len(k),len(line_bin)))
+        return energies,i,j,S2,binning
+
+    def __weights(self,temperatures):
+        from scipy.constants import k as kB
+        from scipy import exp,array,newaxis
+        energies,i,j,S2,binning = self._line_table
+        overlaps = self.overlaps
+        T        = array(temperatures,dtype=float)[:,newaxis]
+
+        E_occupied   = overlaps.energies_occupied
+        E_unoccupied = overlaps.energies_unoccupied
+
+        p_occupied   = exp(-E_occupied[newaxis,:]/(kB*T))
+        p_unoccupied = exp(-E_unoccupied[newaxis,:]/(kB*T))
+
+        if hasattr(overlaps,"partition_function_occupied"):
+            Z_occupied = array([ overlaps.partition_function_occupied(t) for t in T[:,0] ])[:,newaxis]
+        else:
+            Z_occupied = p_occupied.sum(axis=1)[:,newaxis]
+
+        if hasattr(overlaps,"partition_function_unoccupied"):
+            Z_unoccupied = array([ overlaps.partition_function_unoccupied(t) for t in T[:,0] ])[:,newaxis]
+        else:
+            Z_unoccupied = p_unoccupied.sum(axis=1)[:,newaxis]
+
+        p_occupied   /= Z_occupied
+        p_unoccupied /= Z_unoccupied
+
+        oxidation = p_occupied[:,i]*S2
+        reduction = p_unoccupied[:,j]*S2
+
+        if binning is not None:
+            oxidation = binning.dot(oxidation.T).T
+            reduction = binning.dot(reduction.T).T
+        return energies,oxidation,reduction
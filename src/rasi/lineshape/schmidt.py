@@ -18,6 +18,174 @@
 
 from rasi.base import BasicCalculator
 
+def schmidt_overlap_matrix(a,aprime,delta,n_states_occupied,n_states_unoccupied,scaled=False):
+    """
+        Evaluates the overlap recursion of P.P. Schmidt (see SchmidtOverlaps) for
+        the oscillator parameters a = M*omega/hbar, aprime = M*omega'/hbar and the
+        equilibrium shift delta.
+
+        The element I[m,n] only depends on elements with a smaller index sum m+n, 
+        so the matrix is filled anti-diagonal by anti-diagonal (wavefront) with 
+        array operations. The matrix is stored with a padding of two zero rows and
+        columns in front, which takes care of the I[-1,.] = I[.,-1] = 0 convention
+        and makes the edge recursions special cases of the general one.
+
+        For large shifts or large bases the starting value I[0,0] underflows and
+        the whole matrix becomes zero. If scaled is True, every anti-diagonal d
+        is stored as a mantissa normalized to a maximum magnitude of one together
+        with the logarithm L[d] of its scale, so that I[m,n] = M[m,n]*exp(L[m+n]).
+        The scales are only combined at the very end, elements that are truly 
+        smaller than the smallest float become zero but all others stay finite.
+        The rescaling only cures the underflow. For shifts of many zero-point 
+        amplitudes the recursion itself becomes unstable, so in scaled mode the 
+        last row and column, which carry the largest error, are compared with 
+        gauss_hermite_overlap_matrix. If they disagree, the whole matrix is 
+        calculated by the quadrature instead.
+
+        Returns an array of shape (n_states_occupied,n_states_unoccupied).
+    """
+    from math  import sqrt,exp,log
+    from numpy import zeros,arange,add
+    from numpy import exp as aexp
+
+    n_occ = n_states_occupied ; n_unocc = n_states_unoccupied
+    n_diag = n_occ+n_unocc-1
+    I = zeros((n_occ+2,n_unocc+2))
+
+    # Prefactors of the recursion formula
+    A = a*sqrt(aprime)*delta/(sqrt(2)*(a+aprime))
+    B = (a-aprime)/(a+aprime)
+    C = sqrt(a)*aprime*delta/(sqrt(2)*(a+aprime))
+    D = 2*sqrt(a*aprime)/(a+aprime)
+
+    # sqrt(1/(k+1)) and sqrt(k/(k+1)) for k = 0,1,...
+    k = arange(float(max(n_occ,n_unocc)))
+    inv   = (k+1)**-.5
+    ratio = (k/(k+1))**.5
+
+    log_I00 = .5*log(2*sqrt(a*aprime)/(a+aprime))-(a*aprime*delta**2)/(2*(a+aprime))
+    if scaled:
+        # Logarithmic scale of the anti-diagonals, padded with four entries in front
+        L = zeros(n_diag+4) + log_I00
+        I[2,2] = 1.
+    else:
+        I[2,2] = exp(log_I00)
+
+    # Weights of the anti-diagonals d-2,...,d-4 relative to d-1 
+    f2 = f3 = f4 = 1.
+
+    for d in xrange(1,n_diag):
+        # Row indices p of the occupied states on the anti-diagonal p+q = d
+        p_min = max(0,d-n_unocc+1) ; p_max = min(n_occ-1,d)
+        values = zeros(p_max-p_min+1)
+
+        if scaled:
+            Ld = L[d+3]
+            f2 = exp(L[d+2]-Ld) ; f3 = exp(L[d+1]-Ld) ; f4 = exp(L[d]-Ld)
+
+        # Edges: I[d,0] and I[0,d] only depend on the two preceding elements
+        if p_max == d:
+            values[-1] =  ratio[d-1] * B * f2*I[d,2] + sqrt(2./d) * sqrt(a)*aprime/(a+aprime)*delta * I[d+1,2]
+        if p_min == 0:
+            values[0]  = -ratio[d-1] * B * f2*I[2,d] - sqrt(2./d) * a*sqrt(aprime)/(a+aprime)*delta * I[2,d+1]
+
+        # Interior: I[m+1,n+1] from the four preceding anti-diagonals
+        i_min = max(1,p_min) ; i_max = min(p_max,d-1)
+        if i_max >= i_min:
+            p = arange(i_min,i_max+1)
+            q = d-p
+            m = p-1 ; n = q-1
+            # Shift to padded storage
+            p = p+2 ; q = q+2
+            values[i_min-p_min:i_max-p_min+1] = \
+                     - A*inv[n]*I[p,q-1] \
+                     + C*inv[m]*I[p-1,q] \
+                     + f2*( - B*ratio[n]*I[p,q-2] \
+                            + D*inv[m]*inv[n]*I[p-1,q-1] \
+                            + B*ratio[m]*I[p-2,q] ) \
+                     + f3*( - C*inv[m]*ratio[n]*I[p-1,q-2] \
+                            + A*ratio[m]*inv[n]*I[p-2,q-1] ) \
+                     + f4*ratio[m]*ratio[n]*I[p-2,q-2]
+
+        if scaled:
+            r = abs(values).max()
+            if r > 0.:
+                values /= r
+                Ld += log(r)
+            L[d+4] = Ld
+
+        p = arange(p_min,p_max+1)+2
+        I[p,d+4-p] = values
+
+    I = I[2:,2:]
+    if scaled:
+        I *= aexp(L[4:])[add.outer(arange(n_occ),arange(n_unocc))]
+        T_occupied,T_unoccupied = overlap_quadrature_tables(a,aprime,delta,n_occ,n_unocc)
+        last_row    = T_occupied[-1].dot(T_unoccupied.transpose())
+        last_column = T_occupied.dot(T_unoccupied[-1])
+        if not (abs(I[-1]-last_row).max() <= 1e-10 and abs(I[:,-1]-last_column).max() <= 1e-10):
+            I = T_occupied.dot(T_unoccupied.transpose())
+    return I
+
+def hermite_function_table(n,y):
+    """
+        Normalized Hermite functions H_j(y)exp(-y^2/2)/sqrt(2^j j! sqrt(pi)) for
+        j = 0..n-1 at the points y, as arrays (mantissa,log_scale) of shape 
+        (n,len(y)). The values are mantissa*exp(log_scale), the recurrence is 
+        rescaled wherever the mantissas get large, so neither large orders nor
+        large y overflow.
+    """
+    from numpy import zeros,ones,log,pi,asarray
+    y = asarray(y,dtype=float)
+    mantissa  = zeros((n,len(y)))
+    log_scale = zeros((n,len(y)))
+    scale  = -y**2/2 - log(pi)/4
+    h_prev = zeros(len(y)) ; h = ones(len(y))
+    mantissa[0],log_scale[0] = h,scale
+    for j in xrange(1,n):
+        h_prev,h = h,(2./j)**.5*y*h - ((j-1.)/j)**.5*h_prev
+        large = abs(h) > 1e100
+        if large.any():
+            h[large] /= 1e100 ; h_prev[large] /= 1e100
+            scale = scale + large*log(1e100)
+        mantissa[j],log_scale[j] = h,scale
+    return mantissa,log_scale
+
+def overlap_quadrature_tables(a,aprime,delta,n_states_occupied,n_states_unoccupied):
+    """
+        Tables T_occupied (n_states_occupied,K) and T_unoccupied (n_states_unoccupied,K)
+        of the oscillator eigenfunctions at the K Gauss-Hermite nodes of the common
+        Gaussian, including the square roots of the weights, so that the overlap 
+        matrix is T_occupied.dot(T_unoccupied.transpose()). The product of two 
+        eigenfunctions is a polynomial of degree m+n times this Gaussian, so the
+        quadrature is exact for K = (n_states_occupied+n_states_unoccupied)/2+1.
+        All entries are bounded, the result is accurate to the round-off of the 
+        sum, independent of the shift.
+    """
+    from numpy import log,exp,sign,abs,errstate
+    from scipy.special import roots_hermite
+    K = (n_states_occupied+n_states_unoccupied)//2+1
+    s,_ = roots_hermite(K)
+    x = s*(2./(a+aprime))**.5 + aprime*delta/(a+aprime)
+    # The weights including the Gaussian are 1/(K g_{K-1}(s)^2), g the normalized Hermite functions
+    mantissa,log_scale = hermite_function_table(K,s)
+    log_weight = -log(K)/2 - log(abs(mantissa[K-1])) - log_scale[K-1] + log(2./(a+aprime))/4
+    tables = []
+    for n,alpha,y in ((n_states_occupied,a,a**.5*x),(n_states_unoccupied,aprime,aprime**.5*(x-delta))):
+        mantissa,log_scale = hermite_function_table(n,y)
+        with errstate(divide="ignore"):
+            tables.append(sign(mantissa)*exp(log(abs(mantissa))+log_scale+log_weight+log(alpha)/4))
+    return tables
+
+def gauss_hermite_overlap_matrix(a,aprime,delta,n_states_occupied,n_states_unoccupied):
+    """
+        The overlap matrix of schmidt_overlap_matrix, calculated by Gauss-Hermite
+        quadrature (see overlap_quadrature_tables). Stable for all shifts, but 
+        the cost grows with the third power of the number of states.
+    """
+    T_occupied,T_unoccupied = overlap_quadrature_tables(a,aprime,delta,n_states_occupied,n_states_unoccupied)
+    return T_occupied.dot(T_unoccupied.transpose())
+
 class SchmidtOverlaps(BasicCalculator):
     """
         SchmidtOverlaps calculates harmonic oscillator overlaps using the
@@ -32,6 +200,24 @@ class SchmidtOverlaps(BasicCalculator):
         equilibrium_shift ............... Shift between the equilibrium coordinates of the two states
         n_states_occupied ............... Number of vibrational states to consider in the occupied state
         n_states_unoccupied ............. Number of vibrational states to consider in the unoccupied state
+        scaled_recursion ................ Carry out the recursion on rescaled anti-diagonals. Needed for 
+                                          large bases or shifts, where the plain recursion underflows 
+                                          to a zero matrix. Where the recursion becomes unstable, the 
+                                          overlaps are calculated by quadrature instead (see 
+                                          schmidt_overlap_matrix, default: False)
+        temperature ..................... Temperature in Kelvins, only needed in truncated mode. This is
+                                          the highest temperature the truncation is valid for, consumers
+                                          (e.g. DiscreteLineShape) refuse to evaluate the lines at
+                                          higher temperatures
+        occupation_cutoff ............... Switches to truncated mode if not None. Only the vibrational 
+                                          states with a thermal occupation above this value are 
+                                          considered as initial states of a transition, i.e. only 
+                                          the rows (occupied) and columns (unoccupied) belonging to 
+                                          those states are calculated (default: None)
+        overlap_cutoff .................. In truncated mode, overlaps with a magnitude at or below 
+                                          this value are dropped (default: 0.)
+        cache ........................... An OverlapCache to look up and store the overlap matrix
+                                          (default: None)
 
 
         OUTPUT PARAMETERS:
@@ -41,6 +227,9 @@ class SchmidtOverlaps(BasicCalculator):
         energies_unoccupied ............. Array of vibrational energies in the unoccupied state.
         overlap_matrix .................. The overlap matrix between the occupied and unoccupied states
                                           (first index corresponds to occupied, second to unoccupied.
+                                          In truncated mode this is a scipy.sparse.csr_matrix.
+        n_significant_occupied .......... Number of occupied states that are considered as initial states
+        n_significant_unoccupied ........ Number of unoccupied states that are considered as initial states
         """
 
 
@@ -52,76 +241,107 @@ class SchmidtOverlaps(BasicCalculator):
                                   mass                = None,
                                   equilibrium_shift   = None,
                                   n_states_occupied   = 200,
-                                  n_states_unoccupied = 200
+                                  n_states_unoccupied = 200,
+                                  scaled_recursion    = False,
+                                  temperature         = None,
+                                  occupation_cutoff   = None,
+                                  overlap_cutoff      = 0.,
+                                  cache               = None
                                   )
         self.init_output_variables(
-                                  energies_occupied   = None,
-                                  energies_unoccupied = None,
-                                  overlap_matrix      = None
+                                  energies_occupied        = None,
+                                  energies_unoccupied      = None,
+                                  overlap_matrix           = None,
+                                  n_significant_occupied   = None,
+                                  n_significant_unoccupied = None
                                   )
         self.set_variables(kwargs)
 
     def do_update(self):
         from scipy.constants import hbar
-        from math import sqrt,log,pi,exp
-        from scipy import arange,array
+        from scipy import arange
 
         if self.changed :
             omega_occupied = self.omega_occupied ; omega_unoccupied = self.omega_unoccupied
-            mass = self.mass ; equilibrium_shift = self.equilibrium_shift
             n_states_occupied = self.n_states_occupied ; n_states_unoccupied = self.n_states_unoccupied
 
-            # Just change the symbols to those used in Schmidt's paper
-            a      = mass*omega_occupied/hbar
-            aprime = mass*omega_unoccupied/hbar
-            delta  = equilibrium_shift
-
-            # Allocate the mighty mighty overlap array
-            I = [ [ 0. for i in xrange(n_states_unoccupied) ] for j in xrange(n_states_occupied) ]
-
-            # Calculate the initial values
-            I[0][0] = sqrt(2*sqrt(a*aprime)/(a+aprime))*exp(-(a*aprime*delta**2)/(2*(a+aprime)))
-            I[1][0] = (sqrt(2*a)*aprime)/(a+aprime)*delta*I[0][0]
-            I[0][1] = -(sqrt(2*aprime)*a)/(a+aprime)*delta*I[0][0]
-
-            # Now calculate along the edges
-            for m in range(0,n_states_occupied-2):
-                I[m+2][0] =  sqrt((float(m)+1)/(float(m)+2)) * (a-aprime)/(a+aprime) * I[m][0] \
-                                   + sqrt(2./(float(m)+2)) * sqrt(a)*aprime/(a+aprime) * delta * I[m+1][0]
-            for n in range(0,n_states_unoccupied-2):
-                I[0][n+2] =  sqrt((float(n)+1)/(float(n)+2)) * (aprime-a)/(a+aprime) * I[0][n] \
-                                   - sqrt(2./(float(n)+2)) * a*sqrt(aprime)/(a+aprime) * delta * I[0][n+1]
-
-            def do_fill(m,n):
-                II = lambda a,b: 0. if a<0 or b<0 else I[a][b]
-                I[m+1][n+1] = - a*sqrt(aprime)*delta/(sqrt(2)*(a+aprime))*sqrt(1./(float(n)+1))*II(m+1,n) \
-                             - (a-aprime)/(a+aprime)*sqrt(float(n)/(float(n)+1))*II(m+1,n-1) \
-                             + sqrt(a)*aprime*delta/(sqrt(2)*(a+aprime))*sqrt(1./float(m+1))*II(m,n+1) \
-                             + 2*sqrt(a*aprime)/(a+aprime)*sqrt(1./(float(m+1)*float(n+1)))*II(m,n) \
-                             - sqrt(a)*aprime*delta/(sqrt(2)*(a+aprime))*sqrt(float(n)/(float(m+1)*float(n+1)))*II(m,n-1) \
-                             + (a-aprime)/(a+aprime)*sqrt(float(m)/float(m+1))*II(m-1,n+1)\
-                             + a*sqrt(aprime)*delta/(sqrt(2)*(a+aprime))*sqrt(float(m)/(float(m+1)*float(n+1)))*II(m-1,n) \
-                             + sqrt(float(m*n)/(float(m+1)*float(n+1)))*II(m-1,n-1)
-            for i in range(n_states_occupied-1):
-                for j in range(min(i+1,n_states_unoccupied-1)):
-                        do_fill(i-j,j)
-                    
-            for j in range(1,n_states_unoccupied-1):
-                c = 0
-                for i in range(n_states_occupied-2,-1,-1):
-                    m = i
-                    n = j+c
-                    if n > n_states_unoccupied-2:
-                        break
-                    do_fill(m,n)
-                    c += 1
-
-            self.internal_energies_occupied   =   (arange(float(n_states_occupied))+.5)*hbar*omega_occupied
-            self.internal_energies_unoccupied = (arange(float(n_states_unoccupied))+.5)*hbar*omega_unoccupied
-            self.internal_overlap_matrix      = array(I)
+            if self.occupation_cutoff == None:
+                n_significant_occupied   = n_states_occupied
+                n_significant_unoccupied = n_states_unoccupied
+            else:
+                if self.temperature == None:
+                    raise ValueError("Truncated mode requires a temperature.")
+                n_significant_occupied   = self.__n_significant(omega_occupied,n_states_occupied,
+                                                                self.partition_function_occupied)
+                n_significant_unoccupied = self.__n_significant(omega_unoccupied,n_states_unoccupied,
+                                                                self.partition_function_unoccupied)
+
+            # A change of the thermal parameters only matters if it changes the truncation
+            thermal_only = not self.changed_variables().difference(["temperature","occupation_cutoff"])
+            if thermal_only and n_significant_occupied   == self.n_significant_occupied \
+                            and n_significant_unoccupied == self.n_significant_unoccupied:
+                return False
+
+            if self.cache == None:
+                S = self.__overlap_matrix(n_significant_occupied,n_significant_unoccupied)
+            else:
+                key = self.cache.key("SchmidtOverlaps",
+                                     omega_occupied           = float(omega_occupied),
+                                     omega_unoccupied         = float(omega_unoccupied),
+                                     mass                     = float(self.mass),
+                                     equilibrium_shift        = float(self.equilibrium_shift),
+                                     n_states_occupied        = int(n_states_occupied),
+                                     n_states_unoccupied      = int(n_states_unoccupied),
+                                     scaled_recursion         = bool(self.scaled_recursion),
+                                     truncated                = self.occupation_cutoff != None,
+                                     n_significant_occupied   = int(n_significant_occupied),
+                                     n_significant_unoccupied = int(n_significant_unoccupied),
+                                     overlap_cutoff           = float(self.overlap_cutoff))
+                calculate = lambda: { "overlap_matrix": self.__overlap_matrix(n_significant_occupied,n_significant_unoccupied) }
+                S = self.cache.fetch(key,calculate)["overlap_matrix"]
+
+            self.internal_energies_occupied        =   (arange(float(n_states_occupied))+.5)*hbar*omega_occupied
+            self.internal_energies_unoccupied      = (arange(float(n_states_unoccupied))+.5)*hbar*omega_unoccupied
+            self.internal_overlap_matrix           = S
+            self.internal_n_significant_occupied   = n_significant_occupied
+            self.internal_n_significant_unoccupied = n_significant_unoccupied
             return True
         return False
 
+    def __overlap_matrix(self,n_significant_occupied,n_significant_unoccupied):
+        from scipy.constants import hbar
+        n_states_occupied = self.n_states_occupied ; n_states_unoccupied = self.n_states_unoccupied
+
+        # Just change the symbols to those used in Schmidt's paper
+        a      = self.mass*self.omega_occupied/hbar
+        aprime = self.mass*self.omega_unoccupied/hbar
+        delta  = self.equilibrium_shift
+        scaled = self.scaled_recursion
+
+        if self.occupation_cutoff == None:
+            return schmidt_overlap_matrix(a,aprime,delta,n_states_occupied,n_states_unoccupied,scaled=scaled)
+
+        from numpy        import nonzero,concatenate
+        from scipy.sparse import csr_matrix
+        # The leading rows and columns of the overlap matrix only depend on 
+        # themselves in the recursion, so the two bands are calculated separately
+        rows    = schmidt_overlap_matrix(a,aprime,delta,n_significant_occupied,n_states_unoccupied,scaled=scaled)
+        columns = schmidt_overlap_matrix(a,aprime,delta,n_states_occupied,n_significant_unoccupied,
+                                         scaled=scaled)[n_significant_occupied:]
+        i_rows,j_rows = nonzero(abs(rows)    > self.overlap_cutoff)
+        i_cols,j_cols = nonzero(abs(columns) > self.overlap_cutoff)
+        return csr_matrix((concatenate((rows[i_rows,j_rows],columns[i_cols,j_cols])),
+                          (concatenate((i_rows,i_cols+n_significant_occupied)),concatenate((j_rows,j_cols)))),
+                          shape=(n_states_occupied,n_states_unoccupied))
+
+    def __n_significant(self,omega,n_states,partition_function):
+        from scipy.constants import hbar
+        from scipy.constants import k as kB
+        from scipy import arange,exp
+        T = self.temperature
+        occupation = exp(-(arange(float(n_states))+.5)*hbar*omega/(kB*T))/partition_function(T)
+        return max(1,(occupation > self.occupation_cutoff).sum())
+
     def partition_function_occupied(self,temperature):
         from harmonic import harmonic_oscillator_partition_function
         return harmonic_oscillator_partition_function(self.omega_occupied,temperature)
@@ -18,17 +18,105 @@
 
 from rasi.base import BasicCalculator
 
+class LinearInterpolant(object):
+    """
+        Piecewise linear function through the points (grid,values), zero outside
+        of the grid. Works on arrays of any shape.
+    """
+    def __init__(self,grid,values):
+        self.grid   = grid
+        self.values = values
+
+    def __call__(self,E):
+        from numpy import interp
+        return interp(E,self.grid,self.values,left=0.,right=0.)
+
+def adaptive_grid(functions,grid,tolerance,max_points=65536):
+    """
+        Refines grid until all functions are represented by linear interpolation
+        between the grid points within the relative tolerance. The interval
+        midpoints are checked against the interpolation, intervals that fail are
+        bisected again. Values below tolerance times the maximum of a function are
+        only resolved to this absolute accuracy, so the refinement concentrates
+        on the peaks and on the (exponential) tails where the relative change is
+        large.
+
+        The grid grows to at most max_points points (or stays at its initial size
+        if that is larger). If the limit is reached, the midpoints with the 
+        largest errors are inserted in the last round.
+
+        Returns the refined grid and the list of the function values on it.
+    """
+    from numpy import asarray,concatenate,argsort,searchsorted,abs,maximum
+    grid    = asarray(grid,dtype=float)
+    values  = [ asarray(f(grid),dtype=float) for f in functions ]
+    active  = grid[:-1]
+    width   = grid[1:]-grid[:-1]
+    while len(active) > 0 and len(grid) < max_points:
+        mids = active + .5*width
+        # Intervals that cannot be bisected any further in floating point
+        keep = (mids > active) & (mids < active+width)
+        active,width,mids = active[keep],width[keep],mids[keep]
+        if len(mids) == 0:
+            break
+        i_left = searchsorted(grid,active)
+        # Relative error of the interpolation at the midpoints, in units of the tolerance
+        excess = 0.
+        mid_values = []
+        for f,f_grid in zip(functions,values):
+            f_mid   = asarray(f(mids),dtype=float)
+            floor   = tolerance*abs(f_grid).max()
+            error   = abs(f_mid - .5*(f_grid[i_left]+f_grid[i_left+1]))
+            excess  = maximum(excess,error/(tolerance*maximum(abs(f_mid),floor)))
+            mid_values.append(f_mid)
+        failed = excess > 1.
+
+        room = max_points-len(grid)
+        if len(mids) > room:
+            # Only the midpoints with the largest errors fit into the grid
+            keep = excess.argsort(kind="mergesort")[::-1][:room]
+            keep.sort()
+            active,width,mids,failed = active[keep],width[keep],mids[keep],failed[keep]
+            mid_values = [ f_mid[keep] for f_mid in mid_values ]
+
+        order  = argsort(concatenate((grid,mids)),kind="mergesort")
+        grid   = concatenate((grid,mids))[order]
+        values = [ concatenate((f_grid,f_mid))[order] for f_grid,f_mid in zip(values,mid_values) ]
+        # Both halves of failed intervals are checked in the next round
+        active = concatenate((active[failed],mids[failed]))
+        width  = concatenate((.5*width[failed],.5*width[failed]))
+    return grid,values
+
 class LineShapeBuffer(BasicCalculator):
     """
         Samples a lineshape on a given grid. May be used to significantly speed
         up the calculation of numerical integrals.
+
+        INPUT PARAMETERS:
+        lineshape ....................... The lineshape to be buffered
+        energy_grid ..................... The sampling grid, or the initial grid in adaptive mode
+        tolerance ....................... If given, the grid is refined adaptively until the 
+                                          linear interpolation of both lineshapes is accurate 
+                                          to this relative tolerance (see adaptive_grid).
+                                          (default: None)
+        max_points ...................... Maximum size of the adaptive grid (default: 65536)
+
+        OUTPUT PARAMETERS:
+        sampled_grid .................... The grid the lineshape was sampled on
+        oxidation_values ................ The oxidation lineshape on sampled_grid
+        reduction_values ................ The reduction lineshape on sampled_grid
+        oxidation ....................... Interpolating functions (zero outside the grid)
+        reduction ....................... 
     """
     def __init__(self, **kwargs):
         self.init_input_variables(
                                   lineshape   = None,
-                                  energy_grid = None
+                                  energy_grid = None,
+                                  tolerance   = None,
+                                  max_points  = 65536
                                   )
         self.init_output_variables(
+                                  sampled_grid     = None,
                                   oxidation_values = None,
                                   reduction_values = None,
                                   oxidation        = None,
@@ -37,15 +125,131 @@ class LineShapeBuffer(BasicCalculator):
         self.set_variables(kwargs)
 
     def do_update(self):
-        from scipy.interpolate import interp1d
         ls_changed = self.lineshape.update()
 
         if self.changed or ls_changed:
-            self.internal_oxidation_values = self.lineshape.oxidation(self.energy_grid)
-            self.internal_reduction_values = self.lineshape.reduction(self.energy_grid)
+            if self.tolerance == None:
+                grid = self.energy_grid
+                self.internal_oxidation_values = self.lineshape.oxidation(grid)
+                self.internal_reduction_values = self.lineshape.reduction(grid)
+            else:
+                grid,[self.internal_oxidation_values,self.internal_reduction_values] = \
+                        adaptive_grid([self.lineshape.oxidation,self.lineshape.reduction],
+                                      self.energy_grid,self.tolerance,self.max_points)
+            self.internal_sampled_grid = grid
+
+            self.internal_oxidation = LinearInterpolant(grid,self.oxidation_values)
+            self.internal_reduction = LinearInterpolant(grid,self.reduction_values)
+            return True
+        return False
+
+
+class TemperatureLineShapeBuffer(BasicCalculator):
+    """
+        Buffers a lineshape for several temperatures. The lineshape is sampled
+        with its temperature sweeps (oxidation_sweep, reduction_sweep) at the
+        temperature of the buffer, so its own temperature is not used. Sampled
+        lineshapes are kept for up to max_temperatures temperatures and max_bytes
+        of memory, the least recently used are dropped first. All of them are 
+        dropped when the lineshape itself changes.
+
+        INPUT PARAMETERS:
+        lineshape ....................... The lineshape to be buffered
+        temperature ..................... Temperature
+        energy_grid ..................... Sampling grid, or initial grid in adaptive mode
+        tolerance ....................... Relative tolerance for adaptive sampling (see 
+                                          LineShapeBuffer) (default: None)
+        max_points ...................... Maximum size of the adaptive grid (default: 65536)
+        temperature_tolerance ........... If two buffered temperatures around temperature are
+                                          at most this far apart, the lineshape is interpolated
+                                          between them (linearly in 1/T for the logarithm)
+                                          instead of being sampled (default: 0.)
+        max_temperatures ................ Maximum number of buffered temperatures (default: 16)
+        max_bytes ....................... Maximum memory of the buffered values (default: 64 MiB)
+
+        OUTPUT PARAMETERS:
+        sampled_grid, oxidation_values, reduction_values, oxidation, reduction ... see LineShapeBuffer
+    """
+    def __init__(self, **kwargs):
+        from collections import OrderedDict
+        self.init_input_variables(
+                                  lineshape             = None,
+                                  temperature           = None,
+                                  energy_grid           = None,
+                                  tolerance             = None,
+                                  max_points            = 65536,
+                                  temperature_tolerance = 0.,
+                                  max_temperatures      = 16,
+                                  max_bytes             = 64*2**20
+                                  )
+        self.init_output_variables(
+                                  sampled_grid     = None,
+                                  oxidation_values = None,
+                                  reduction_values = None,
+                                  oxidation        = None,
+                                  reduction        = None
+                                  )
+        self.__dict__["_buffered"] = OrderedDict()
+        self.set_variables(kwargs)
+
+    def __sample(self,T):
+        from numpy import asarray
+        oxidation = lambda E: self.lineshape.oxidation_sweep(E,[T])[0]
+        reduction = lambda E: self.lineshape.reduction_sweep(E,[T])[0]
+        if self.tolerance == None:
+            grid = asarray(self.energy_grid,dtype=float)
+            return grid,oxidation(grid),reduction(grid)
+        grid,[oxidation_values,reduction_values] = adaptive_grid([oxidation,reduction],self.energy_grid,
+                                                                 self.tolerance,self.max_points)
+        return grid,oxidation_values,reduction_values
 
-            self.internal_oxidation = interp1d(self.energy_grid,self.oxidation_values,bounds_error=False,fill_value=0.)  
-            self.internal_reduction = interp1d(self.energy_grid,self.reduction_values,bounds_error=False,fill_value=0.)  
+    def __interpolate(self,T):
+        from numpy import union1d,log,exp,where,interp
+        temperatures = sorted(self._buffered.iterkeys())
+        lower  = [ Tb for Tb in temperatures if Tb < T ]
+        higher = [ Tb for Tb in temperatures if Tb > T ]
+        if not lower or not higher or higher[0]-lower[-1] > self.temperature_tolerance:
+            return None
+        T1,T2 = lower[-1],higher[0]
+        (grid1,ox1,red1),(grid2,ox2,red2) = self._buffered[T1],self._buffered[T2]
+        grid = union1d(grid1,grid2)
+        # The thermal factors are exponential in 1/T
+        t = (1./T-1./T1)/(1./T2-1./T1)
+        def interpolate(v1,v2):
+            v1 = interp(grid,grid1,v1) ; v2 = interp(grid,grid2,v2)
+            nonzero = (v1 > 0) & (v2 > 0)
+            logv1 = log(where(nonzero,v1,1.)) ; logv2 = log(where(nonzero,v2,1.))
+            return where(nonzero,exp((1.-t)*logv1+t*logv2),(1.-t)*v1+t*v2)
+        return grid,interpolate(ox1,ox2),interpolate(red1,red2)
+
+    def __remember(self,T,sampled):
+        buffered = self._buffered
+        buffered[T] = sampled
+        nbytes = lambda (grid,ox,red): grid.nbytes+ox.nbytes+red.nbytes
+        while len(buffered) > 1 and (len(buffered) > self.max_temperatures \
+                                     or sum(nbytes(entry) for entry in buffered.itervalues()) > self.max_bytes):
+            buffered.popitem(last=False)
+
+    def do_update(self):
+        ls_changed = self.lineshape.update()
+        changed = self.changed_variables()
+        if ls_changed or changed.difference(["temperature","temperature_tolerance","max_temperatures","max_bytes"]):
+            self._buffered.clear()
+
+        if self.changed or ls_changed:
+            T = float(self.temperature)
+            if T in self._buffered:
+                sampled = self._buffered.pop(T)
+                self._buffered[T] = sampled
+            else:
+                sampled = self.__interpolate(T)
+                if sampled == None:
+                    sampled = self.__sample(T)
+                    self.__remember(T,sampled)
+            grid,self.internal_oxidation_values,self.internal_reduction_values = sampled
+            self.internal_sampled_grid = grid
+            self.internal_oxidation = LinearInterpolant(grid,self.oxidation_values)
+            self.internal_reduction = LinearInterpolant(grid,self.reduction_values)
             return True
         return False
 
@@ -74,6 +278,14 @@ class LineShapeEnergyCorrector(BasicCalculator):
         E_c = self.correction_energy
         return self.lineshape.reduction(E + E_c)
 
+    def oxidation_sweep(self,E,temperatures):
+        E_c = self.correction_energy
+        return self.lineshape.oxidation_sweep(E + E_c,temperatures)
+
+    def reduction_sweep(self,E,temperatures):
+        E_c = self.correction_energy
+        return self.lineshape.reduction_sweep(E + E_c,temperatures)
+
 def calc_modal_vector(atoms1,atoms2):
     """
         Calculate the 'modal vector', i.e. the difference vector between the two configurations.
@@ -105,6 +317,16 @@ def calc_modal_vector(atoms1,atoms2):
     return dot(modal_vector_frac,cell)
 
 
+def write_data(filename,*columns):
+    """
+        Writes the columns (sequences of numbers of equal length) to a text file.
+    """
+    outfile = open(filename,"w")
+    for line in zip(*columns):
+        print >> outfile, ("%e  "*len(line))%line
+    outfile.close()
+
+
 
 ############# Everything below this line may be legacy code. ####################
 """
@@ -147,12 +369,6 @@ def interpolate(x,xs,ys):
     k = (yr-yl)/(xr-xl)
     return yl+k*(x-xl)
 
-def write_data(filename,*columns):
-    outfile = open(filename,"w")
-    for line in zip(*columns):
-        print >> outfile, ("%e  "*len(line))%line
-    outfile.close()
-
 def write_matrix(filename,matrix):
     outfile = open(filename,"w")
     iters = [ vec.__iter__() for vec in matrix ]
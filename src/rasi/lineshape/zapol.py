@@ -17,28 +17,28 @@
 ###############################################################################
 
 
-from constants import *
-
-def a_template(binom):
-    def a(k,l,j):
-        t = j+k+l
-        if t%2:
-            return 0
-        else:
-            t /= 2
-            pmin = max(0,(k-j-l)/2)
-            pmax = min(k,(k-j+l)/2)
-            return sum( (-1)**p*binom(k,p)*binom(l,t-j-p) for p in range(pmin,pmax+1))
-    return a
-
-def h_table (n,xval): 
-    h = [ 1 , 2*xval ]
-    for i in range(2,n+1):
-        h += [ 2*xval*h[-1] - 2*(i-1)*h[-2] ]
-    return h
-
-fast_binom = lambda factab: \
-                lambda n,k: factab[n]/(factab[k]*factab[n-k])
+from scipy.constants import hbar as hred
+
+def scaled_hermite_table(n,xval):
+    """
+        Normalized Hermite polynomials H_k(x)/sqrt(2^k k!)*exp(-x^2/2) for k = 0..n 
+        as (mantissa,log_scale) arrays, the values are mantissa*exp(log_scale). The
+        recurrence is rescaled whenever the mantissas get large, so neither large 
+        orders nor large x overflow.
+    """
+    from numpy import zeros,log
+    mantissa  = zeros(n+1)
+    log_scale = zeros(n+1)
+    scale = -xval**2/2
+    h_prev,h = 0.,1.
+    mantissa[0],log_scale[0] = h,scale
+    for k in range(1,n+1):
+        h_prev,h = h,(2./k)**.5*xval*h - ((k-1.)/k)**.5*h_prev
+        if abs(h) > 1e100:
+            h_prev /= 1e100 ; h /= 1e100
+            scale  += log(1e100)
+        mantissa[k],log_scale[k] = h,scale
+    return mantissa,log_scale
 
 def ZAPOL_overlaps( 
                    # Physical parameters
@@ -52,9 +52,28 @@ def ZAPOL_overlaps(
                                # Number of final eigenstates to consider
                    echo=True     # Report status to stdout
                    ):
-    from math import log,sin,cos,exp,atan
-    from scipy.special import gammaln
-    from sys import stdout
+    #
+    # The overlap of the initial state m and the final state n is a series over 
+    # j of a(m,n,j) trig(j*theta) H[(m+n+j)/2] H[(m+n-j)/2], where a(m,n,j) is the
+    # coefficient of y^j in (y-1/y)^m (y+1/y)^n. Instead of the coefficients and
+    # Hermite polynomials themselves, which overflow for large m+n, the 
+    # normalized quantities (N = m+n, k = (N+j)/2)
+    #
+    #    d(N,m,k) = a(m,n,2k-N) sqrt(k!(N-k)!/(m!n!2^N))
+    #    h(k)     = H[k]/sqrt(2^k k!) exp(-rho^2/2)
+    #
+    # are used. For fixed N, d is an orthogonal matrix, so it is built up over N
+    # by the (stable) rotation recurrence
+    #
+    #    d(N+1,m,k) = [ sqrt(N+1-m) ( sqrt(k) d(N,m,k-1) + sqrt(N+1-k) d(N,m,k) )
+    #                 + sqrt(m)     ( sqrt(k) d(N,m-1,k-1) - sqrt(N+1-k) d(N,m-1,k) ) ] / (sqrt(2)(N+1))
+    #
+    # h is kept in log-scaled form (see scaled_hermite_table) and the overlaps 
+    # with m+n = N (an anti-diagonal of the overlap matrix) are a single 
+    # matrix-vector product.
+    #
+    from math import atan
+    from numpy import arange,zeros,exp,sqrt,maximum,sin,cos
 
     if echo:
         print
@@ -66,90 +85,58 @@ def ZAPOL_overlaps(
     if n_eigs_f == None:
         n_eigs_f = n_eigs_i
     
-    if echo:
-        print;print "Building factorial table...";print
-    factab = [ 1 ]
-    for i in range(1,max(n_eigs_i,n_eigs_f)+1):
-        factab += [ factab[-1] * i ]
-    binom = fast_binom(factab)
-    a = a_template(binom)        
-    ld_e = 1/log(2)
     theta = atan((omega_f/omega_i)**.5)
-    s = sin(theta)
-    c = cos(theta)
 
     omega = omega_i*omega_f/(omega_i+omega_f)
     rho = (m*omega/(2*hred))**.5 *x_s
 
     if echo:
         print;print "Building Hermite table...";print
-    H = h_table(n_eigs_i+n_eigs_f,rho)
+    n_max = n_eigs_i+n_eigs_f
+    h_mantissa,h_log_scale = scaled_hermite_table(n_max,rho)
 
     if echo:
         print;print "Calculating overlaps...";print
-    LS = []
 
     Ew_i = [ hred*omega_i*(.5+m) for m in range(n_eigs_i) ]
     Ew_f = [ hred*omega_f*(.5+m) for m in range(n_eigs_f) ]
 
-    amn = []
-    S = []
-    pct=(n_eigs_i-1)/10
-    nxt=pct
-    if echo:
-        stdout.write("0%...");stdout.flush()
-    for m in range(n_eigs_i):
-        if echo and m >= nxt:
-            if m/pct < 10:
-                stdout.write("%d0%%..."%(m/pct));stdout.flush()
-            else:
-                stdout.write("100%\n");stdout.flush()
-            nxt+=pct
-        S_i = []
-        for n in range(n_eigs_f):
-            if n == 0:
-                amn = [ a(m,n,j) for j in range(m+n+1) ]
-            else:
-                amn = [ a(m,n,0) ] + [ amn[j-1]+amn[j+1] for j in range(1,m+n-1) ]
-                if m+n > 1:
-                    amn += [ a(m,n,m+n-1) ]
-                if m+n > 0:
-                    amn += [ a(m,n,m+n) ]
-            sgn=1
-            if m%2:
-                I = 0.
-                for j in range(1,m+n+1):
-                    u=j+m+n
-                    if u%2:
-                        continue
-                    else:
-                        u/=2
-                        I += amn[j]*sin(j*theta)*H[u]*H[u-j]
-                Ipre = (1-(m+n)/2.)/ld_e
-                sgn*=(-1)**((m+1)/2)
-            else:
-                I= 0.
-                for j in range(1,m+n+1):
-                    u=j+m+n
-                    if u%2:
-                        continue
-                    else:
-                        u/=2
-                        I += amn[j]*cos(j*theta)*H[u]*H[u-j]
-                I *= 2
-                if n%2 == 0:
-                    I += a(m,n,0)*H[(m+n)/2]**2
-                Ipre = (-(m+n)/2.)/ld_e
-                sgn*=(-1)**(m/2)
-            integ = sgn*(-1)**(m+n)*sin(2*theta)**.5*I*exp(Ipre-((m+n)/ld_e+gammaln(m+1)+gammaln(n+1))/2-rho**2)
-            Ef = hred*omega_f*(n+.5)
-            S_i.append(integ)
-        S.append(S_i)
+    mm  = arange(n_eigs_i)
+    odd = (mm%2 == 1)
+    sgn = ((-1.)**((mm+1)/2)*odd + (-1.)**(mm/2)*(~odd))*sin(2*theta)**.5
+
+    S = zeros((n_eigs_i,n_eigs_f))
+    d = zeros((n_eigs_i,n_max))
+    d[0,0] = 1.
+    for N in range(n_max-1):
+        # Overlaps on the anti-diagonal m+n = N
+        m_lower = max(0,N-n_eigs_f+1)
+        m_upper = min(N,n_eigs_i-1)
+        if m_lower <= m_upper:
+            k  = arange(N+1)
+            hh = h_mantissa[k]*h_mantissa[N-k]*exp(h_log_scale[k]+h_log_scale[N-k])
+            rows = slice(m_lower,m_upper+1)
+            angle = (2*k-N)*theta
+            series_odd  = d[rows,:N+1].dot(sin(angle)*hh)
+            series_even = d[rows,:N+1].dot(cos(angle)*hh)
+            m = mm[rows]
+            S[m,N-m] = sgn[rows]*(-1.)**N*(series_odd*odd[rows] + series_even*(~odd[rows]))
+
+        # d(N,...) -> d(N+1,...)
+        n_rows = min(n_eigs_i,N+2)
+        k  = arange(N+2)[None,:]
+        mr = arange(n_rows)[:,None]
+        d_k   = d[:n_rows,:N+2]
+        d_km1 = zeros(d_k.shape) ; d_km1[:,1:] = d_k[:,:-1]
+        d_m1_k   = zeros(d_k.shape) ; d_m1_k[1:]   = d_k[:-1]
+        d_m1_km1 = zeros(d_k.shape) ; d_m1_km1[1:] = d_km1[:-1]
+        d[:n_rows,:N+2] = ( sqrt(maximum(N+1-mr,0))*(sqrt(k)*d_km1 + sqrt(N+1-k)*d_k) 
+                          + sqrt(mr)*(sqrt(k)*d_m1_km1 - sqrt(N+1-k)*d_m1_k) )/(2**.5*(N+1))
     return Ew_i,Ew_f,S
 
 
 if __name__=="__main__":
-    from units import *
+    from scipy.constants import atomic_mass as amu, angstrom as Ang, eV
     #print "Testing mode!!!"
     mass = 24.6619642123*amu
     x_s = 0.55779*Ang 
@@ -18,12 +18,44 @@
 
 from rasi.base import BasicCalculator
 
+def trapezoidal_weights(E):
+    """
+        Returns the weights w of the trapezoidal rule on the grid E, i.e. 
+        sum(w*f) == trapz(f,E).
+    """
+    from numpy import zeros,diff
+    w = zeros(len(E))
+    if len(E) > 1:
+        h = diff(E)
+        w[:-1] += .5*h
+        w[1:]  += .5*h
+    return w
+
 class FullNMPTransition(BasicCalculator):
+    """
+        Calculates the oxidation and reduction rates of a defect from the lineshape
+        function and the reservoirs of the electronic matrix element.
+
+        INPUT PARAMETERS:
+        lineshape ..................... The lineshape calculator
+        electronic_matrix_element ..... Provides Ev, oxidation_reservoir and reduction_reservoir
+        mlambda ....................... Prefactor of the rates
+        batched ....................... Evaluate the lineshape for all reservoirs in a single call
+                                        (default: False). The lineshape values and the quadrature
+                                        weights are kept per reservoir energy grid and only the 
+                                        grids that changed are evaluated again, unless the lineshape
+                                        or Ev changed.
+
+        OUTPUT PARAMETERS:
+        oxidation_rate ................ 
+        reduction_rate ................ 
+    """
     def __init__(self, **kwargs):
         self.init_input_variables(
                     lineshape = None,
                     electronic_matrix_element = None,
-                    mlambda                   = None
+                    mlambda                   = None,
+                    batched                   = False
                     )
         self.init_output_variables(
                 oxidation_rate = None,
@@ -37,6 +69,10 @@ class FullNMPTransition(BasicCalculator):
         ls_changed = self.lineshape.update()
         em_changed = self.electronic_matrix_element.update()
         changed = (self.changed or ls_changed or em_changed)
+        if changed and self.batched:
+            lineshape_changed = ls_changed or "lineshape" in self.changed_variables()
+            self.internal_oxidation_rate,self.internal_reduction_rate = self.__batched_rates(lineshape_changed)
+            return True
         if changed:
             eme = self.electronic_matrix_element
             oxidation_lsf = self.lineshape.oxidation
@@ -54,7 +90,234 @@ class FullNMPTransition(BasicCalculator):
             self.internal_reduction_rate = reduction_rate
             return True
         return False
+
+    def __batched_rates(self,lineshape_changed):
+        from numpy import concatenate,cumsum,split,dot,array,array_equal
+        eme = self.electronic_matrix_element
+        Ev  = eme.Ev
+        # Per direction: reservoir name -> (E,weights,lineshape values on E)
+        grids = self.__dict__.get("_reservoir_grids")
+        if grids == None or lineshape_changed or not array_equal(grids[0],Ev):
+            # A copy, so in-place changes of an array Ev are detected
+            grids = array(Ev,copy=True),{},{}
+            self.__dict__["_reservoir_grids"] = grids
+
+        rates = []
+        for reservoir,lsf,cached in ((eme.oxidation_reservoir,self.lineshape.oxidation,grids[1]),
+                                     (eme.reduction_reservoir,self.lineshape.reduction,grids[2])):
+            for name in cached.keys():
+                if name not in reservoir:
+                    del cached[name]
+            missing = []
+            for name,(E,d) in reservoir.iteritems():
+                if name in cached and array_equal(cached[name][0],E):
+                    continue
+                missing.append(name)
+            if missing:
+                grids_missing = [ reservoir[name][0] for name in missing ]
+                values = lsf(concatenate(grids_missing)-Ev)
+                bounds = cumsum([ len(E) for E in grids_missing ])[:-1]
+                for name,E,values_E in zip(missing,grids_missing,split(values,bounds)):
+                    # A copy, so in-place changes of the reservoir grid are detected
+                    cached[name] = array(E,copy=True),trapezoidal_weights(E),values_E
+            rate = 0.
+            for name,(E,d) in reservoir.iteritems():
+                _,weights,values_E = cached[name]
+                rate += dot(weights,d*values_E)
+            rates.append(self.mlambda*rate)
+        return rates
+
+    def temperature_sweep(self,temperatures):
+        """
+            Calculates the rates for a whole array of temperatures at once. The
+            lineshape has to provide oxidation_sweep and reduction_sweep. The 
+            calculator is updated first, so all inputs have to be set.
+
+            Returns (oxidation_rates,reduction_rates) as arrays of len(temperatures).
+        """
+        from scipy.integrate import trapz
+        from scipy import zeros
+        self.update()
+        eme = self.electronic_matrix_element
+        mlambda = self.mlambda
+        Ev = eme.Ev
+        oxidation_rates = zeros(len(temperatures))
+        reduction_rates = zeros(len(temperatures))
+        for E,d in eme.oxidation_reservoir.itervalues():
+            oxidation_rates += mlambda*trapz(d*self.lineshape.oxidation_sweep(E-Ev,temperatures),E)
+        for E,d in eme.reduction_reservoir.itervalues():
+            reduction_rates += mlambda*trapz(d*self.lineshape.reduction_sweep(E-Ev,temperatures),E)
+        return oxidation_rates,reduction_rates
     
+
+class NMPRateTable(object):
+    """
+        Oxidation and reduction rates of a FullNMPTransition, tabulated over a grid
+        of shifts of the valence band edge Ev and temperatures.
+
+        In a bias sweep, only the band edges of the electronic matrix element move
+        while the reservoirs stay the same. The table is calculated once with
+
+            table = NMPRateTable.tabulate(transition,shifts,temperatures)
+
+        which evaluates the rates at Ev+shift for all shifts and temperatures using
+        the temperature sweeps of the lineshape (see FullNMPTransition.temperature_sweep).
+        Rates are then looked up by bicubic spline interpolation of their logarithm,
+        see rates(). Tables can be stored with save() and read with NMPRateTable.load().
+    """
+    def __init__(self,shifts,temperatures,oxidation_rates,reduction_rates):
+        from numpy import asarray
+        self.shifts          = asarray(shifts,dtype=float)
+        self.temperatures    = asarray(temperatures,dtype=float)
+        self.oxidation_rates = asarray(oxidation_rates,dtype=float)
+        self.reduction_rates = asarray(reduction_rates,dtype=float)
+        shape = (len(self.shifts),len(self.temperatures))
+        if self.oxidation_rates.shape != shape or self.reduction_rates.shape != shape:
+            raise ValueError("Rate tables must have the shape (len(shifts),len(temperatures))")
+        NMPRateTable.check_grid(self.shifts,self.temperatures)
+        self.__splines = None
+
+    @staticmethod
+    def check_grid(shifts,temperatures):
+        """
+            The error estimate of rates() uses the spline through every other grid
+            point, which has to cover the whole table. Hence, both axes need an odd
+            number of at least 3 points.
+        """
+        for name,axis in (("shifts",shifts),("temperatures",temperatures)):
+            if len(axis) < 3 or len(axis)%2 == 0:
+                raise ValueError("NMPRateTable requires an odd number of at least 3 %s, got %d."%(name,len(axis)))
+
+    @classmethod
+    def tabulate(cls,transition,shifts,temperatures):
+        """
+            Calculates the rates of the FullNMPTransition transition for Ev shifted
+            by all shifts and all temperatures. The transition is updated first,
+            its lineshape has to provide oxidation_sweep and reduction_sweep. Both
+            grids need an odd number of at least 3 points (see check_grid).
+        """
+        from numpy import asarray,zeros,subtract,dot
+        shifts       = asarray(shifts,dtype=float)
+        temperatures = asarray(temperatures,dtype=float)
+        cls.check_grid(shifts,temperatures)
+        transition.update()
+        eme = transition.electronic_matrix_element
+        lineshape = transition.lineshape
+        Ev  = eme.Ev
+        tables = []
+        for reservoir,sweep in ((eme.oxidation_reservoir,lineshape.oxidation_sweep),
+                                (eme.reduction_reservoir,lineshape.reduction_sweep)):
+            rates = zeros((len(shifts),len(temperatures)))
+            for E,d in reservoir.itervalues():
+                # All shifts in a single sweep, shape (temperatures,shifts,E)
+                values = sweep(subtract.outer(-shifts,Ev-E),temperatures)
+                rates += transition.mlambda*dot(values,trapezoidal_weights(E)*d).T
+            tables.append(rates)
+        return cls(shifts,temperatures,*tables)
+
+    def save(self,filename):
+        from numpy import savez
+        savez(filename,shifts=self.shifts,temperatures=self.temperatures,
+                       oxidation_rates=self.oxidation_rates,reduction_rates=self.reduction_rates)
+
+    @classmethod
+    def load(cls,filename):
+        from numpy import load
+        data = load(filename)
+        try:
+            return cls(data["shifts"],data["temperatures"],data["oxidation_rates"],data["reduction_rates"])
+        finally:
+            data.close()
+
+    def __spline(self,shifts,temperatures,rates):
+        from scipy.interpolate import RectBivariateSpline
+        from numpy import log,maximum,finfo
+        return RectBivariateSpline(shifts,temperatures,log(maximum(rates,finfo(float).tiny)),
+                                   kx=min(3,len(shifts)-1),ky=min(3,len(temperatures)-1))
+
+    def rates(self,shifts,temperatures,error=False):
+        """
+            Interpolates the rates at the points (shifts,temperatures), which are 
+            broadcast against each other. Returns (oxidation_rates,reduction_rates).
+
+            With error=True, indicators of the relative interpolation errors are 
+            returned as well. They are the deviations from the spline of the table
+            with every other point left out. Since that spline has twice the grid
+            spacing, the indicators are usually above the actual errors and can
+            serve as a rough bound. They are not scaled by the asymptotic h^4 
+            convergence of cubic splines, which the tables often do not reach.
+        """
+        from numpy import asarray,broadcast_arrays,exp,abs
+        shifts,temperatures = broadcast_arrays(asarray(shifts,dtype=float),asarray(temperatures,dtype=float))
+        if ((shifts < self.shifts[0]) | (shifts > self.shifts[-1])).any() \
+           or ((temperatures < self.temperatures[0]) | (temperatures > self.temperatures[-1])).any():
+            raise ValueError("Rate query outside of the tabulated range")
+        if self.__splines == None:
+            self.__splines = [ (self.__spline(self.shifts,self.temperatures,rates),
+                                self.__spline(self.shifts[::2],self.temperatures[::2],rates[::2,::2])) 
+                               for rates in (self.oxidation_rates,self.reduction_rates) ]
+        result = []
+        errors = []
+        for fine,coarse in self.__splines:
+            log_rates = fine.ev(shifts.ravel(),temperatures.ravel()).reshape(shifts.shape)
+            result.append(exp(log_rates))
+            if error:
+                log_coarse = coarse.ev(shifts.ravel(),temperatures.ravel()).reshape(shifts.shape)
+                errors.append(abs(exp(log_coarse-log_rates)-1.))
+        if error:
+            return result[0],result[1],errors[0],errors[1]
+        return result[0],result[1]
+
+
+class TabulatedNMPTransition(BasicCalculator):
+    """
+        Drop-in replacement for a FullNMPTransition that looks the rates up in an 
+        NMPRateTable.
+
+        INPUT PARAMETERS:
+        table ......................... The NMPRateTable
+        shift ......................... Shift of Ev relative to the tabulated transition
+        temperature ................... Temperature
+
+        OUTPUT PARAMETERS:
+        oxidation_rate ................ 
+        reduction_rate ................ 
+        oxidation_error ............... Indicator of the relative interpolation error (see NMPRateTable.rates)
+        reduction_error ............... 
+    """
+    def __init__(self, **kwargs):
+        self.init_input_variables(
+                    table       = None,
+                    shift       = 0.,
+                    temperature = None
+                    )
+        self.init_output_variables(
+                oxidation_rate  = None,
+                reduction_rate  = None,
+                oxidation_error = None,
+                reduction_error = None
+                )
+        self.set_variables(kwargs)
+
+    def do_update(self):
+        if self.changed:
+            rates = self.table.rates(self.shift,self.temperature,error=True)
+            self.internal_oxidation_rate,self.internal_reduction_rate   = rates[0][()],rates[1][()]
+            self.internal_oxidation_error,self.internal_reduction_error = rates[2][()],rates[3][()]
+            return True
+        return False
+
+    def temperature_sweep(self,temperatures):
+        """
+            Looks the rates up for a whole array of temperatures at once, like
+            FullNMPTransition.temperature_sweep.
+
+            Returns (oxidation_rates,reduction_rates) as arrays of len(temperatures).
+        """
+        from numpy import asarray
+        self.update()
+        return self.table.rates(self.shift,asarray(temperatures,dtype=float))
+
     
 class ColdCarrierNumerical(object):
     def __init__(self):
@@ -83,3 +83,28 @@ class RateCalculator4State(BasicCalculator):
                 self.timeconstants[key] = rate**-1
         return changed
 
+    def temperature_sweep(self,temperatures):
+        """
+            Calculates the rates for a whole array of temperatures at once. The
+            temperature is applied to the barrier rates as well as to both NMP 
+            rate calculators (see FullNMPTransition.temperature_sweep), so all 
+            temperature dependent nodes of the tree are swept consistently. 
+            Truncated overlaps (see SchmidtOverlaps.occupation_cutoff) have to be 
+            truncated at max(temperatures) or above, otherwise a ValueError is raised.
+
+            :param temperatures: Array of temperatures
+            :returns: A dictionary with the same keys as *rates*, containing arrays 
+                      of len(temperatures)
+        """
+        from scipy.constants import k as kB
+        from scipy import exp,array
+        self.update()
+        T = array(temperatures,dtype=float)
+        rates = {}
+        rates["1->2'"],rates["2'->1"] = self.recharge_primary.temperature_sweep(T)
+        rates["1'->2"],rates["2->1'"] = self.recharge_secondary.temperature_sweep(T)
+        nu = self.nu
+        for transition,Eb in self.energies.iteritems():
+            rates[transition] = nu * exp( -Eb/(kB*T) )
+        return rates
+